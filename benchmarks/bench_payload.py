@@ -0,0 +1,99 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_payload
+# Purpose:     Micro-benchmark of the columnar payload builders against the
+#              original iterrows based payload functions.
+#
+# Author:      Bill DeVoe, Maine Department of Marine Resources
+#
+# License:     MIT
+#-------------------------------------------------------------------------------
+import os
+import sys
+import timeit
+import pandas as pd
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'form_syncer'))
+sys.path.insert(0, os.path.join(root, 'option_list_syncer'))
+import ifb_form_syncer
+import ifb_list_syncer
+
+## Original iterrows implementations, kept here as the baseline
+def df_to_ifb_iterrows(df):
+    dcns = list(df.columns)
+    parsed = list()
+    for index, row in df.iterrows():
+        flds = list()
+        for dcn in dcns:
+            flds.append({'element_name': dcn, 'value': row[dcn]})
+        parsed.append({'fields': flds})
+    return parsed
+
+def df_to_ifb_u_iterrows(df):
+    dcns = list(df.columns)
+    parsed = list()
+    for index, row in df.iterrows():
+        flds = list()
+        for dcn in dcns:
+            if dcn == 'id':
+                continue
+            flds.append({'element_name': dcn, 'value': row[dcn]})
+        parsed.append({'id': row['id'], 'fields': flds})
+    return parsed
+
+def options_iterrows(options, with_id = False):
+    body = list()
+    for index, row in options.iterrows():
+        option = {'key_value': row['key_value'], 'label': row['label'],
+                  'sort_order': row['sort_order'], 'condition_value': row['condition_value']}
+        if with_id:
+            option = dict({'id': row['id']}, **option)
+        body.append(option)
+    return body
+
+## Columnar implementations, collected from the chunk generators
+def options_columnar(options, with_id = False):
+    body = list()
+    for chunk in ifb_list_syncer.iter_option_bodies(options, with_id = with_id):
+        body.extend(chunk)
+    return body
+
+# Builds a test table of text columns
+def make_records(nrow, ncol):
+    data = {'col%s' % c: ['value %s %s' % (r, c) for r in range(nrow)] for c in range(ncol)}
+    df = pd.DataFrame(data)
+    df_u = df.copy()
+    df_u['id'] = range(nrow)
+    return df, df_u
+
+def make_options(nrow):
+    options = pd.DataFrame({'id': range(nrow),
+                            'key_value': ['key_%s' % r for r in range(nrow)],
+                            'label': ['Label %s' % r for r in range(nrow)],
+                            'sort_order': [str(r) for r in range(nrow)],
+                            'condition_value': [''] * nrow})
+    return options
+
+# Times a function on its input, returning the best of repeated runs in seconds
+def best_time(func, *args, repeat = 3):
+    return min(timeit.repeat(lambda: func(*args), number = 1, repeat = repeat))
+
+def main():
+    print("%-26s %8s %12s %12s %8s" % ('case', 'rows', 'iterrows s', 'columnar s', 'speedup'))
+    for nrow, ncol in [(1000, 10), (10000, 10), (100000, 10), (10000, 40)]:
+        df, df_u = make_records(nrow, ncol)
+        options = make_options(nrow)
+        cases = [('df_to_ifb (%s cols)' % ncol, df_to_ifb_iterrows, ifb_form_syncer.df_to_ifb, (df,)),
+                 ('df_to_ifb_u (%s cols)' % ncol, df_to_ifb_u_iterrows, ifb_form_syncer.df_to_ifb_u, (df_u,))]
+        if ncol == 10:
+            cases += [('send_options body', options_iterrows, options_columnar, (options,)),
+                      ('send_update body', options_iterrows, options_columnar, (options, True))]
+        for name, old, new, args in cases:
+            # Both implementations must produce identical payloads
+            assert old(*args) == new(*args), "Payload mismatch for %s" % name
+            t_old = best_time(old, *args)
+            t_new = best_time(new, *args)
+            print("%-26s %8s %12.3f %12.3f %7.1fx" % (name, nrow, t_old, t_new, t_old / t_new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_startup
+# Purpose:     Measures the start-up cost of the syncers: module import, and
+#              loading a small CSV and building its payloads in a fresh
+#              interpreter, on the fast path and on the pandas path.
+#
+# Author:      Bill DeVoe, Maine Department of Marine Resources
+#
+# License:     MIT
+#-------------------------------------------------------------------------------
+import os
+import sys
+import subprocess
+import statistics
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+form_dir = os.path.join(root, 'form_syncer')
+list_dir = os.path.join(root, 'option_list_syncer')
+sys.path.insert(0, form_dir)
+import ifb_form_syncer
+
+# Number of fresh interpreters started per case
+runs = 10
+
+# Settings stand-in holding what the CSV loaders read
+class bench_settings():
+    def __init__(self, cur_dir):
+        self.cur_dir = cur_dir
+        self.field_length = 50
+        self.infer_types = False
+
+# Writes a lookup table CSV of nrow rows
+def write_csv(path, nrow):
+    with open(path, 'w') as f:
+        f.write('site_id,site_name,region,depth_m\n')
+        for i in range(nrow):
+            f.write('%s,Site %s,"Region %s, ME",%s\n' % (i, i, i % 7, i * 3))
+
+# CSV files the fast path reads differently than a plain table, each checked
+# to build the same payloads as pandas
+edge_csvs = {'blank_lines.csv': 'a,b\n1,2\n\n   \n\t\n3,4\n',
+             'blank_values.csv': 'a,b\n1,2\n,\n  ,  \n""\n"   "\n 5 \n',
+             'quoted_lines.csv': 'a,b\n"x\n\n   ",2\n"\n",4\n'}
+
+# Exits with an error if the fast path reads the CSV into other payloads
+# than load_csv and df_to_ifb; files left to pandas by the fast path pass
+def check_parity(tmp, csv_in):
+    s = bench_settings(tmp)
+    loaded = ifb_form_syncer.load_csv_rows(csv_in, s, 1000)
+    if loaded is None:
+        return
+    dcns, rows = loaded
+    fast = [body for chunk in ifb_form_syncer.iter_row_bodies(dcns, rows) for body in chunk]
+    ifb_form_syncer.load_pandas()
+    slow = ifb_form_syncer.df_to_ifb(ifb_form_syncer.load_csv(csv_in, s))
+    if fast != slow:
+        sys.exit("ERROR: fast path payloads of %s differ from load_csv/df_to_ifb payloads." % csv_in)
+
+# Median wall time in ms of running code in a fresh interpreter
+def time_fresh(code):
+    times = list()
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check = True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+def main():
+    tmp = tempfile.mkdtemp()
+    write_csv(os.path.join(tmp, 'small.csv'), 50)
+    # Both paths must build the same payloads
+    for csv_in, text in edge_csvs.items():
+        with open(os.path.join(tmp, csv_in), 'w', newline = '') as f:
+            f.write(text)
+    for csv_in in ['small.csv'] + list(edge_csvs):
+        check_parity(tmp, csv_in)
+    setup = ("import sys; sys.path.insert(0, %r); sys.path.insert(0, %r)\n"
+             "class S: cur_dir = %r; field_length = 50; infer_types = False\n" % (form_dir, list_dir, tmp))
+    cases = [
+        ('python (empty)', 'pass'),
+        ('import pandas', 'import pandas'),
+        ('import ifb_form_syncer', setup + 'import ifb_form_syncer'),
+        ('import ifb_list_syncer', setup + 'import ifb_list_syncer'),
+        ('50 rows, fast path', setup + 'import ifb_form_syncer as m\n'
+            'dcns, rows = m.load_csv_rows("small.csv", S, 1000)\n'
+            'body = list(m.iter_row_bodies(dcns, rows))'),
+        ('50 rows, pandas path', setup + 'import ifb_form_syncer as m\n'
+            'm.load_pandas()\n'
+            'body = m.df_to_ifb(m.load_csv("small.csv", S))'),
+    ]
+    print("Median of %s fresh interpreters per case" % runs)
+    print("%-26s %10s" % ('Case', 'ms'))
+    for name, code in cases:
+        print("%-26s %10.1f" % (name, time_fresh(code)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_sync
+# Purpose:     End to end sync benchmark of ifb_form_syncer and ifb_list_syncer
+#              against the local mock iFormBuilder server, reporting rows per
+#              second, API calls and peak memory of each scenario.
+#
+# Author:      Bill DeVoe, Maine Department of Marine Resources
+#
+# License:     MIT
+#-------------------------------------------------------------------------------
+import argparse
+import contextlib
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(bench_dir)
+sys.path.insert(0, bench_dir)
+import mock_ifb_server
+
+# Share of rows changed in the update scenario and removed in the delete scenario
+change_share = 10
+
+# Options per option list in the option list scenarios
+options_per_list = 1000
+
+## Source data
+
+# Writes a form CSV of nrow rows; rows whose number is a multiple of
+# change_share get a changed value if changed, and are left out if trimmed
+def write_form_csv(path, nrow, changed = False, trimmed = False):
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['site_id', 'site_name', 'region', 'depth_m', 'notes'])
+        for i in range(nrow):
+            hit = i % change_share == 0
+            if trimmed and hit:
+                continue
+            notes = 'changed' if changed and hit else 'note %s' % (i % 97)
+            writer.writerow([i, 'Site %s' % i, 'Region %s' % (i % 13), i % 200, notes])
+
+# Writes an option list CSV of nrow options in lists of options_per_list
+def write_list_csv(path, nrow, prefix, changed = False, trimmed = False):
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'key_value', 'label', 'sort_order', 'condition_value'])
+        for i in range(nrow):
+            hit = i % change_share == 0
+            if trimmed and hit:
+                continue
+            label = 'Changed %s' % i if changed and hit else 'Option %s' % i
+            writer.writerow(['%s_%s' % (prefix, i // options_per_list), 'k%s' % i, label,
+                             i % options_per_list, ''])
+
+# Writes an INI file for a scenario
+def write_ini(path, section, options, workers, rate_limit = 0):
+    lines = ['[API]', 'server_name: mock', 'profile_id: 1', 'ifb_key: bench', 'ifb_secret: bench',
+             '[%s]' % section] + ['%s: %s' % item for item in options.items()] + \
+            ['[Performance]', 'workers: %s' % workers, 'rate_limit: %s' % rate_limit]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+## Scenario runs
+
+# Peak resident memory of this process in MB, or None if not available
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in KB elsewhere
+    return peak / 1024.0 / 1024.0 if sys.platform == 'darwin' else peak / 1024.0
+
+# Runs one sync in this process and prints its result as JSON; run through
+# run_scenario so that every scenario has its own peak memory
+def run_child(kind, cur_dir, config_fn, url):
+    sys.path.insert(0, os.path.join(root, 'form_syncer' if kind == 'form' else 'option_list_syncer'))
+    module = __import__('ifb_form_syncer' if kind == 'form' else 'ifb_list_syncer')
+    api = mock_ifb_server.mock_api(url)
+    result = {'calls': None, 'error': ''}
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            result['calls'] = module.sync(cur_dir, config_fn, True, api = api)
+        except SystemExit as e:
+            result['error'] = str(e)
+        except Exception as e:
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - start
+    result['rss_mb'] = peak_rss_mb()
+    print(json.dumps(result))
+
+# Runs a scenario in a fresh interpreter, returning its result
+def run_scenario(kind, cur_dir, config_fn, url):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', kind, cur_dir, config_fn, url],
+                         check = True, stdout = subprocess.PIPE, universal_newlines = True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+# Form scenarios for nrow rows: (mode, csv writer arguments, Form options)
+def form_scenarios(nrow):
+    page = 'bench_%s' % nrow
+    base = {'form_label': 'Bench', 'field_length': 100}
+    return [
+        ('overwrite', {}, dict(base, form_name = 'bench_ow_%s' % nrow)),
+        ('append-only', {}, dict(base, form_name = page, uid_col = 'site_id')),
+        ('update', {'changed': True}, dict(base, form_name = page, uid_col = 'site_id', update = True)),
+        ('delete', {'changed': True, 'trimmed': True},
+            dict(base, form_name = page, uid_col = 'site_id', update = True, delete = True)),
+    ]
+
+# Option list scenarios for nrow rows; option lists have no overwrite mode
+def list_scenarios(nrow):
+    return [
+        ('append-only', {}, {}),
+        ('update', {'changed': True}, {'update': True}),
+        ('delete', {'changed': True, 'trimmed': True}, {'update': True, 'delete': True}),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description = "Sync benchmark against the mock iFormBuilder server.")
+    parser.add_argument('--sizes', default = '1000,100000,1000000', help = "comma separated row counts")
+    parser.add_argument('--programs', default = 'form,list', help = "form, list or both")
+    parser.add_argument('--workers', type = int, default = 4, help = "[Performance] workers of each sync")
+    parser.add_argument('--latency-ms', type = float, default = 0, help = "mock server delay per response")
+    parser.add_argument('--rate-limit', type = float, default = 0, help = "mock server requests per second, 0 for none")
+    parser.add_argument('--client-rate-limit', type = float, default = 0,
+                        help = "[Performance] rate_limit of each sync, 0 for none")
+    parser.add_argument('--token-ttl', type = float, default = 0, help = "mock server token lifetime in seconds, 0 for none")
+    parser.add_argument('--output', help = "CSV file to write the results to")
+    args = parser.parse_args()
+    server = mock_ifb_server.start_server(0, args.latency_ms, args.rate_limit, args.token_ttl)
+    url = 'http://127.0.0.1:%s' % server.server_port
+    tmp = tempfile.mkdtemp()
+    results = list()
+    print("%-6s %-12s %9s %9s %10s %9s %9s  %s" %
+            ('Prog', 'Mode', 'Rows', 'Seconds', 'Rows/s', 'Calls', 'Peak MB', 'Error'))
+    for nrow in [int(size) for size in args.sizes.split(',')]:
+        for kind in args.programs.split(','):
+            scenarios = form_scenarios(nrow) if kind == 'form' else list_scenarios(nrow)
+            for mode, data_args, options in scenarios:
+                csv_fn = '%s_%s_%s.csv' % (kind, nrow, mode)
+                ini_fn = '%s_%s_%s.ini' % (kind, nrow, mode)
+                if kind == 'form':
+                    write_form_csv(os.path.join(tmp, csv_fn), nrow, **data_args)
+                    write_ini(os.path.join(tmp, ini_fn), 'Form', dict(options, csv_in = csv_fn), args.workers,
+                              args.client_rate_limit)
+                else:
+                    write_list_csv(os.path.join(tmp, csv_fn), nrow, 'bench_%s' % nrow, **data_args)
+                    write_ini(os.path.join(tmp, ini_fn), 'List', dict(options, csv_in = csv_fn), args.workers,
+                              args.client_rate_limit)
+                res = run_scenario(kind, tmp, ini_fn, url)
+                rss = '%.0f' % res['rss_mb'] if res['rss_mb'] is not None else 'n/a'
+                print("%-6s %-12s %9s %9.2f %10.0f %9s %9s  %s" %
+                        (kind, mode, nrow, res['seconds'], nrow / max(res['seconds'], 1e-9),
+                         res['calls'], rss, res['error']))
+                sys.stdout.flush()
+                results.append(dict(res, program = kind, mode = mode, rows = nrow))
+    if args.output:
+        with open(args.output, 'w', newline = '') as f:
+            writer = csv.DictWriter(f, ['program', 'mode', 'rows', 'seconds', 'calls', 'rss_mb', 'error'])
+            writer.writeheader()
+            writer.writerows(results)
+    server.shutdown()
+
+if __name__ == '__main__':
+    if len(sys.argv) == 6 and sys.argv[1] == '--child':
+        run_child(*sys.argv[2:])
+    else:
+        main()
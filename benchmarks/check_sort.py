@@ -0,0 +1,60 @@
+#-------------------------------------------------------------------------------
+# Name:        check_sort
+# Purpose:     Checks the sort orders the option list syncer gives with
+#              sort_gap against fixed cases, exiting with an error if any
+#              case gives other sort orders.
+#
+# Author:      Bill DeVoe, Maine Department of Marine Resources
+#
+# License:     MIT
+#-------------------------------------------------------------------------------
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'option_list_syncer'))
+import ifb_list_syncer
+
+# Fixed cases as name, source keys in order, current sort orders by key,
+# number of current sort orders changed, and the sort orders expected for the
+# source keys with a sort_gap of 10
+cases = [
+    # Sort order 0 leaves no room below a, so a moves as well
+    ('insert at top', ['n', 'a', 'b', 'c', 'd', 'e'], {'a': 0, 'b': 10, 'c': 20, 'd': 30, 'e': 40}, 1,
+     [2, 6, 10, 20, 30, 40]),
+    ('single move', ['a', 'e', 'b', 'c', 'd'], {'a': 0, 'b': 10, 'c': 20, 'd': 30, 'e': 40}, 1,
+     [0, 5, 10, 20, 30]),
+    # No room below a, so all are renumbered gap apart
+    ('reversal', ['e', 'd', 'c', 'b', 'a'], {'a': 0, 'b': 10, 'c': 20, 'd': 30, 'e': 40}, 4,
+     [0, 10, 20, 30, 40]),
+    # Options kept in IFB but not in the source hold their sort orders
+    ('kept options', ['a', 'n', 'b', 'm'], {'a': 0, 'x': 5, 'b': 10, 'y': 20}, 0, [0, 4, 10, 21]),
+    ('empty list', [], {}, 0, []),
+]
+
+# Sort orders reconcile_sort gives the source keys, in order, against current
+# options at the given sort orders, as whole numbers
+def reconciled(src_keys, cur, gap = 10):
+    pd = ifb_list_syncer.pd
+    op_df = pd.DataFrame({'key_value': src_keys, 'sort_order': [str(r) for r in range(len(src_keys))]})
+    cur_ops = pd.DataFrame({'key_value_cur': list(cur.keys()), 'sort_order_cur': [str(v) for v in cur.values()]})
+    return [int(val) for val in ifb_list_syncer.reconcile_sort(op_df, cur_ops, gap)]
+
+def main():
+    ifb_list_syncer.load_pandas()
+    if ifb_list_syncer.increasing_run([5, 1, None, 2, 9, 3]) != {1, 3, 5}:
+        sys.exit("ERROR: increasing_run did not find the longest increasing run.")
+    for name, src_keys, cur, changed, expected in cases:
+        new = reconciled(src_keys, cur)
+        kept = [val for key, val in cur.items() if key not in src_keys]
+        # Sort orders follow the source order and are not held by any option
+        if new != sorted(new) or len(set(new + kept)) < len(new) + len(kept):
+            sys.exit("ERROR: Sort orders of case %s are out of order or not unique: %s" % (name, new))
+        moved = sum([1 for key, val in zip(src_keys, new) if key in cur and cur[key] != val])
+        if moved != changed or new != expected:
+            sys.exit("ERROR: Sort orders of case %s are %s, expected %s." % (name, new, expected))
+        print("     %s: %s" % (name, new))
+    print("All %s sort order cases passed." % len(cases))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,485 @@
+#-------------------------------------------------------------------------------
+# Name:        mock_ifb_server
+# Purpose:     Local stand-in for the iFormBuilder API used to benchmark the
+#              syncers: token, pages, elements, records, option lists and
+#              options endpoints with paging, field grammar filters, and
+#              configurable latency and rate limits. Also provides mock_api,
+#              a client with the ifb-wrapper methods the syncers call.
+#
+# Author:      Bill DeVoe, Maine Department of Marine Resources
+#
+# License:     MIT
+#-------------------------------------------------------------------------------
+import argparse
+import datetime
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Largest page of results returned per request, by collection
+page_limits = {'pages': 100, 'elements': 100, 'records': 1000, 'optionlists': 100, 'options': 1000}
+
+## Field grammar
+
+# Splits a field grammar such as id,name(="a"|="b"),modified_date(>"x") on
+# the commas outside parentheses and quotes
+def split_grammar(grammar):
+    parts, depth, quoted, cur = list(), 0, False, ''
+    for ch in grammar:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == '(':
+            depth += 1
+        elif not quoted and ch == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and ch == ',':
+            parts.append(cur)
+            cur = ''
+            continue
+        cur += ch
+    if cur:
+        parts.append(cur)
+    return parts
+
+# Parses a field grammar to a list of (field, conditions), each condition a
+# list of (operator, value) alternatives
+def parse_grammar(grammar):
+    fields = list()
+    for part in split_grammar(grammar or ''):
+        m = re.match(r'\s*(\w+)\s*(?:\((.*)\))?\s*$', part)
+        if m is None:
+            raise ValueError("Invalid field grammar: %s" % part)
+        name, cond = m.groups()
+        alts = list()
+        if cond:
+            for alt in re.findall(r'(>=|<=|!=|=|>|<)\s*"((?:[^"\\]|\\.)*)"', cond):
+                alts.append(alt)
+        fields.append((name, alts))
+    return fields
+
+ops = {'=': lambda a, b: a == b, '!=': lambda a, b: a != b, '>': lambda a, b: a > b,
+       '<': lambda a, b: a < b, '>=': lambda a, b: a >= b, '<=': lambda a, b: a <= b}
+
+# True if an item meets every condition of a parsed grammar
+def matches(item, fields):
+    for name, alts in fields:
+        if len(alts) == 0:
+            continue
+        val = item.get(name)
+        val = '' if val is None else str(val)
+        if not any([ops[op](val, ref) for op, ref in alts]):
+            return False
+    return True
+
+## In-memory profile data
+
+# Class holding one collection of items by id, e.g. the records of a page
+class collection():
+    def __init__(self):
+        self.items = dict()
+        # Incremented on every change, invalidating cached query results
+        self.version = 0
+        self.cache = dict()
+
+    # Ids of items matching a parsed grammar, in id order
+    def query(self, fields):
+        conds = [(name, alts) for name, alts in fields if alts]
+        key = (self.version, repr(conds))
+        if key in self.cache:
+            return self.cache[key]
+        # Direct lookup when filtering on id equality only
+        if len(conds) == 1 and conds[0][0] == 'id' and all([op == '=' for op, ref in conds[0][1]]):
+            ids = sorted([int(ref) for op, ref in conds[0][1] if ref.isdigit() and int(ref) in self.items])
+        else:
+            ids = [item_id for item_id, item in self.items.items() if matches(item, conds)]
+        self.cache = {key: ids}
+        return ids
+
+    def changed(self):
+        self.version += 1
+
+# Class holding the state of the mock server
+class mock_state():
+    def __init__(self, latency_ms = 0, rate_limit = 0, token_ttl = 0):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1000)
+        self.latency = latency_ms / 1000.0
+        # Token bucket refilled at rate_limit requests per second, 0 for none
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit
+        self.refilled = time.time()
+        # Seconds an access token is valid, 0 for no expiry, and the expiry
+        # time of each token issued
+        self.token_ttl = token_ttl
+        self.tokens_issued = dict()
+        self.pages = collection()
+        self.optionlists = collection()
+        # Elements and records by page id, options by option list id
+        self.elements = dict()
+        self.records = dict()
+        self.options = dict()
+        self.requests = 0
+
+    # Takes a rate limit token; returns seconds to wait if none is left
+    def throttle(self):
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit <= 0:
+                return 0
+            now = time.time()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.refilled) * self.rate_limit)
+            self.refilled = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate_limit
+            self.tokens -= 1
+            return 0
+
+    def new_id(self):
+        return next(self.ids)
+
+    # Issues a new access token
+    def new_token(self):
+        with self.lock:
+            token = 'mock-token-%s' % next(self.ids)
+            self.tokens_issued[token] = time.time() + self.token_ttl if self.token_ttl > 0 else None
+            return token
+
+    # Whether an Authorization header holds a token that has not expired
+    def valid_token(self, header):
+        token = (header or '')[len('Bearer '):]
+        with self.lock:
+            if token not in self.tokens_issued:
+                return False
+            expires = self.tokens_issued[token]
+            return expires is None or time.time() < expires
+
+# Current time in the format of IFB modified dates
+def now_text():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
+
+# Projects an item to the fields of a parsed grammar, or all fields if none
+def project(item, fields):
+    if len(fields) == 0:
+        return dict(item)
+    return dict([(name, item.get(name)) for name, alts in fields])
+
+# Reads a page of items from a collection
+def read_items(coll, query, limit_name):
+    fields = parse_grammar(query.get('fields', ''))
+    offset = int(query.get('offset', 0))
+    limit = min(int(query.get('limit', page_limits[limit_name])), page_limits[limit_name])
+    ids = coll.query(fields)
+    return [project(coll.items[item_id], fields) for item_id in ids[offset:offset + limit]]
+
+# Creates items in a collection from a body of one item or a list of items
+def create_items(state, coll, body, build):
+    items = body if isinstance(body, list) else [body]
+    out = list()
+    for item in items:
+        item_id = state.new_id()
+        coll.items[item_id] = build(item_id, item)
+        out.append({'id': item_id})
+    coll.changed()
+    return out if isinstance(body, list) else out[0]
+
+# Updates items by the id of each item in the body, or every item matching
+# the grammar with a single body
+def update_items(coll, body, query, apply):
+    if isinstance(body, list):
+        targets = [(int(item['id']), item) for item in body if int(item['id']) in coll.items]
+    else:
+        ids = coll.query(parse_grammar(query.get('fields', '')))
+        limit = int(query.get('limit', len(ids)))
+        targets = [(item_id, body) for item_id in ids[:limit]]
+    for item_id, item in targets:
+        apply(coll.items[item_id], item)
+    coll.changed()
+    return [{'id': item_id} for item_id, item in targets]
+
+# Deletes up to limit items matching the grammar
+def delete_items(coll, query, limit_name):
+    ids = coll.query(parse_grammar(query.get('fields', '')))
+    limit = min(int(query.get('limit', page_limits[limit_name])), page_limits[limit_name])
+    ids = ids[:limit]
+    for item_id in ids:
+        del coll.items[item_id]
+    coll.changed()
+    return [{'id': item_id} for item_id in ids]
+
+def build_record(item_id, item):
+    record = {'id': item_id, 'created_date': now_text(), 'modified_date': now_text()}
+    record.update([(fld['element_name'], fld['value']) for fld in item.get('fields', [])])
+    return record
+
+def apply_record(record, item):
+    record.update([(fld['element_name'], fld['value']) for fld in item.get('fields', [])])
+    record['modified_date'] = now_text()
+
+def build_option(item_id, item):
+    option = {'id': item_id, 'key_value': '', 'label': '', 'sort_order': 0, 'condition_value': ''}
+    option.update([(k, v) for k, v in item.items() if k != 'id'])
+    return option
+
+def apply_option(option, item):
+    option.update([(k, v) for k, v in item.items() if k != 'id'])
+
+## HTTP handler
+
+base = '/exzact/api/v60/profiles/(\\d+)'
+routes = [
+    ('pages', re.compile(base + '/pages$')),
+    ('elements', re.compile(base + '/pages/(\\d+)/elements$')),
+    ('records', re.compile(base + '/pages/(\\d+)/records$')),
+    ('optionlists', re.compile(base + '/optionlists$')),
+    ('options', re.compile(base + '/optionlists/(\\d+)/options$')),
+]
+
+class mock_handler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests, as the IFB API does
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers = None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        return raw
+
+    def handle_any(self, method):
+        state = self.server.state
+        raw = self.read_body()
+        wait = state.throttle()
+        if wait > 0:
+            self.send_json(429, {'error': 'rate limit exceeded'}, {'Retry-After': '%.3f' % wait})
+            return
+        if state.latency > 0:
+            time.sleep(state.latency)
+        url = urlparse(self.path)
+        query = dict([(k, v[0]) for k, v in parse_qs(url.query).items()])
+        if url.path == '/exzact/api/oauth/token' and method == 'POST':
+            self.send_json(200, {'access_token': state.new_token(), 'token_type': 'Bearer',
+                                 'expires_in': state.token_ttl or 3600})
+            return
+        if not state.valid_token(self.headers.get('Authorization')):
+            self.send_json(401, {'error': 'invalid token'})
+            return
+        for name, pattern in routes:
+            m = pattern.match(url.path)
+            if m is None:
+                continue
+            try:
+                body = json.loads(raw) if raw else None
+                self.total_count = None
+                with state.lock:
+                    status, data = self.dispatch(state, name, method, [int(g) for g in m.groups()], body, query)
+            except (ValueError, KeyError, TypeError) as e:
+                status, data = 400, {'error': str(e)}
+            headers = {'Total-Count': str(self.total_count)} if self.total_count is not None else None
+            self.send_json(status, data, headers)
+            return
+        self.send_json(404, {'error': 'not found'})
+
+    # Reads a page of items, sending the number of items matching the grammar
+    # in the Total-Count header as the IFB API does
+    def read(self, coll, query, limit_name):
+        self.total_count = len(coll.query(parse_grammar(query.get('fields', ''))))
+        return 200, read_items(coll, query, limit_name)
+
+    def dispatch(self, state, name, method, ids, body, query):
+        if name == 'pages':
+            if method == 'GET':
+                return self.read(state.pages, query, 'pages')
+            if method == 'POST':
+                page = create_items(state, state.pages, body, lambda i, item: {'id': i, 'name': item['name'],
+                                                                               'label': item.get('label', '')})
+                state.elements[page['id']] = collection()
+                state.records[page['id']] = collection()
+                return 201, page
+        if name == 'optionlists':
+            if method == 'GET':
+                return self.read(state.optionlists, query, 'optionlists')
+            if method == 'POST':
+                op_list = create_items(state, state.optionlists, body, lambda i, item: {'id': i, 'name': item['name']})
+                state.options[op_list['id']] = collection()
+                return 201, op_list
+        if name == 'elements':
+            coll = state.elements.get(ids[1])
+            if coll is None:
+                return 404, {'error': 'page not found'}
+            if method == 'GET':
+                return self.read(coll, query, 'elements')
+            if method == 'POST':
+                return 201, create_items(state, coll, body, lambda i, item: dict(item, id = i))
+        if name in ['records', 'options']:
+            colls = state.records if name == 'records' else state.options
+            coll = colls.get(ids[1])
+            if coll is None:
+                return 404, {'error': '%s container not found' % name}
+            build, apply = (build_record, apply_record) if name == 'records' else (build_option, apply_option)
+            if method == 'GET':
+                return self.read(coll, query, name)
+            if method == 'POST':
+                return 201, create_items(state, coll, body, build)
+            if method == 'PUT':
+                return 200, update_items(coll, body, query, apply)
+            if method == 'DELETE':
+                return 200, delete_items(coll, query, name)
+        return 405, {'error': 'method not allowed'}
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PUT(self):
+        self.handle_any('PUT')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+# Starts the mock server in a background thread, returning the server; its
+# URL is http://127.0.0.1:<server.server_port>
+def start_server(port = 0, latency_ms = 0, rate_limit = 0, token_ttl = 0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), mock_handler)
+    server.daemon_threads = True
+    server.state = mock_state(latency_ms, rate_limit, token_ttl)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+## Client
+
+# Client for the mock server with the ifb-wrapper methods used by the
+# syncers. Requests go through a requests session, so the syncers' metered
+# API counts them and their request scheduler retries throttled requests and
+# refreshes expired tokens through requestAccessToken, as with ifb-wrapper
+class mock_api():
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.requestAccessToken()
+
+    def requestAccessToken(self):
+        res = self.session.post(self.url + '/exzact/api/oauth/token',
+                                data = {'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer'})
+        res.raise_for_status()
+        self.access_token = res.json()['access_token']
+        self.session.headers.update({'Authorization': 'Bearer %s' % self.access_token})
+
+    def request(self, method, path, params = None, body = None):
+        res = self.session.request(method, self.url + '/exzact/api/v60' + path, params = params, json = body)
+        res.raise_for_status()
+        return res.json()
+
+    # Reads every page of a collection
+    def read_all(self, path, grammar, limit):
+        out, offset = list(), 0
+        while True:
+            params = {'offset': offset, 'limit': limit}
+            if grammar:
+                params['fields'] = grammar
+            batch = self.request('GET', path, params)
+            out.extend(batch)
+            if len(batch) < limit:
+                return out
+            offset += limit
+
+    def readPages(self, profile_id, grammar = None, offset = 0, limit = 100):
+        return self.read_all('/profiles/%s/pages' % profile_id, grammar or 'id,name', 100)
+
+    def createPage(self, profile_id, body):
+        return self.request('POST', '/profiles/%s/pages' % profile_id, body = body)
+
+    def readElements(self, profile_id, page_id, grammar = None, offset = 0, limit = 100):
+        return self.read_all('/profiles/%s/pages/%s/elements' % (profile_id, page_id), grammar or 'id,name', 100)
+
+    def createElements(self, profile_id, page_id, body):
+        return self.request('POST', '/profiles/%s/pages/%s/elements' % (profile_id, page_id), body = body)
+
+    def readRecords(self, profile_id, page_id, grammar = None, offset = 0, limit = 100):
+        params = {'offset': offset, 'limit': limit}
+        if grammar:
+            params['fields'] = grammar
+        return self.request('GET', '/profiles/%s/pages/%s/records' % (profile_id, page_id), params)
+
+    def readAllRecords(self, profile_id, page_id, grammar = None):
+        return self.read_all('/profiles/%s/pages/%s/records' % (profile_id, page_id), grammar, 1000)
+
+    def createRecords(self, profile_id, page_id, body):
+        return self.request('POST', '/profiles/%s/pages/%s/records' % (profile_id, page_id), body = body)
+
+    def updateAllRecords(self, profile_id, page_id, body, grammar = None):
+        params = {'fields': grammar} if grammar else None
+        return self.request('PUT', '/profiles/%s/pages/%s/records' % (profile_id, page_id), params, body)
+
+    def deleteRecords(self, profile_id, page_id, grammar = None, offset = 0, limit = 100):
+        params = {'limit': limit}
+        if grammar:
+            params['fields'] = grammar
+        return self.request('DELETE', '/profiles/%s/pages/%s/records' % (profile_id, page_id), params)
+
+    def deleteAllRecords(self, profile_id, page_id, grammar = None):
+        out = list()
+        while True:
+            batch = self.deleteRecords(profile_id, page_id, grammar, limit = 1000)
+            out.extend(batch)
+            if len(batch) < 1000:
+                return out
+
+    def readAllOptionLists(self, profile_id, grammar = None):
+        return self.read_all('/profiles/%s/optionlists' % profile_id, grammar or 'id,name', 100)
+
+    def createOptionList(self, profile_id, body):
+        return self.request('POST', '/profiles/%s/optionlists' % profile_id, body = body)
+
+    def readAllOptions(self, profile_id, option_list_id, grammar = None):
+        return self.read_all('/profiles/%s/optionlists/%s/options' % (profile_id, option_list_id), grammar, 1000)
+
+    def createOptions(self, profile_id, option_list_id, body):
+        return self.request('POST', '/profiles/%s/optionlists/%s/options' % (profile_id, option_list_id), body = body)
+
+    def updateOptions(self, profile_id, option_list_id, body, grammar = None, offset = 0, limit = 1000):
+        params = {'fields': grammar} if grammar else None
+        return self.request('PUT', '/profiles/%s/optionlists/%s/options' % (profile_id, option_list_id), params, body)
+
+    def deleteOptions(self, profile_id, option_list_id, grammar = None, offset = 0, limit = 1000):
+        params = {'limit': limit}
+        if grammar:
+            params['fields'] = grammar
+        return self.request('DELETE', '/profiles/%s/optionlists/%s/options' % (profile_id, option_list_id), params)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Local mock of the iFormBuilder API.")
+    parser.add_argument('--port', type = int, default = 8080, help = "port to listen on, 0 for any free port")
+    parser.add_argument('--latency-ms', type = float, default = 0, help = "delay added to every response")
+    parser.add_argument('--rate-limit', type = float, default = 0, help = "requests per second before 429 responses, 0 for none")
+    parser.add_argument('--token-ttl', type = float, default = 0, help = "seconds access tokens are valid, 0 for no expiry")
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency_ms, args.rate_limit, args.token_ttl)
+    print("Listening on http://127.0.0.1:%s" % server.server_port)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
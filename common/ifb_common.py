@@ -0,0 +1,442 @@
+#-------------------------------------------------------------------------------
+# Name:        ifb_common
+# Purpose:     Code shared by the form and option list syncers: sync targets,
+#              file hashes, and the request scheduler and run metrics of API
+#              sessions.
+#
+# Author:      Bill DeVoe, Maine Department of Marine Resources
+#
+# Created:     09/22/2020
+# Copyright:   (c) Bill DeVoe 2020
+# License:     MIT
+#-------------------------------------------------------------------------------
+import copy
+import csv
+import hashlib
+import json
+import time
+import random
+import datetime
+import bisect
+import os
+import threading
+import requests
+
+# Class holding one destination of a sync: a server and profile, with the
+# API credentials used for it, and the outcome of syncing it. The [API]
+# destination has no name
+class target():
+    def __init__(self, name, server_name, profile_id, ifb_key, ifb_secret):
+        self.name = name
+        self.server_name = server_name
+        self.profile_id = profile_id
+        self.ifb_key = ifb_key
+        self.ifb_secret = ifb_secret
+        # ok or failed
+        self.status = None
+        self.calls = None
+        self.seconds = 0
+        self.error = ''
+
+# Copy of the settings for syncing target t; the files a named target keeps
+# next to the INI file, and its metrics file, have its name added
+def target_settings(settings, t):
+    ts = copy.copy(settings)
+    ts.target = t.name
+    ts.server_name = t.server_name
+    ts.profile_id = t.profile_id
+    ts.ifb_key = t.ifb_key
+    ts.ifb_secret = t.ifb_secret
+    if settings.metrics_file and t.name:
+        root, ext = os.path.splitext(settings.metrics_file)
+        ts.metrics_file = '%s_%s%s' % (root, t.name, ext)
+    return ts
+
+# Name of the files kept next to the INI file for the target of a sync,
+# without their suffix
+def file_stem(settings):
+    stem = os.path.splitext(settings.config_fn)[0]
+    return stem + '_' + settings.target if settings.target else stem
+
+# SHA-256 hash of the contents of a file, read in blocks
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+# Thread-local record of the metrics and API method a call is made for; set
+# by metered_api around each call, so HTTP requests made by the API wrapper
+# are counted against the run that made them. scope names the option list a
+# worker thread is syncing
+metrics_local = threading.local()
+
+# Upper bounds in ms of the request latency histogram buckets
+latency_buckets = [50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Class collecting API requests, bytes, latencies and phase timings of a run
+class metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # Wall time in seconds and requests of each phase, in order
+        self.phases = dict()
+        self.phase_requests = dict()
+        self.current = None
+        self.phase_start = None
+        # Totals over all HTTP requests
+        self.requests = 0
+        self.errors = 0
+        # Requests repeated by the scheduler, and those refused by throttling
+        self.retries = 0
+        self.throttled = 0
+        # Bytes of unchanged fields left out of update payloads
+        self.bytes_saved = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latencies = list()
+        # Calls, requests and seconds per API method
+        self.methods = dict()
+        # Requests per option list
+        self.scopes = dict()
+
+    # Ends the current phase, if any, and starts timing the named phase
+    def phase(self, name = None):
+        now = time.time()
+        with self.lock:
+            if self.current is not None:
+                self.phases[self.current] += now - self.phase_start
+            self.current = name
+            self.phase_start = now
+            if name is not None:
+                self.phases.setdefault(name, 0.0)
+                self.phase_requests.setdefault(name, 0)
+
+    # Method entry, created on first use
+    def method(self, name):
+        return self.methods.setdefault(name, {'calls': 0, 'requests': 0, 'seconds': 0.0})
+
+    # Records one HTTP request made for an API method
+    def record_request(self, name, seconds, sent, received, ok):
+        with self.lock:
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.latencies.append(seconds * 1000)
+            self.method(name)['requests'] += 1
+            if self.current is not None:
+                self.phase_requests[self.current] += 1
+            scope = getattr(metrics_local, 'scope', None)
+            if scope is not None:
+                self.scopes[scope] = self.scopes.get(scope, 0) + 1
+
+    # Requests made while syncing an option list
+    def scope_requests(self, scope):
+        with self.lock:
+            return self.scopes.get(scope, 0)
+
+    # Records a request the scheduler is about to repeat
+    def record_retry(self, throttled):
+        with self.lock:
+            self.retries += 1
+            self.throttled += 1 if throttled else 0
+
+    # Records bytes left out of update payloads
+    def record_saved(self, nbytes):
+        with self.lock:
+            self.bytes_saved += nbytes
+
+    # Records one call of an API method
+    def record_call(self, name, seconds):
+        with self.lock:
+            entry = self.method(name)
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+
+    # Metrics of the run as a dictionary
+    def report(self):
+        with self.lock:
+            lat = sorted(self.latencies)
+            hist = [0] * (len(latency_buckets) + 1)
+            for ms in lat:
+                hist[bisect.bisect_left(latency_buckets, ms)] += 1
+            pct = lambda q: round(lat[min(int(q * len(lat)), len(lat) - 1)], 1) if lat else 0
+            report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                      'seconds': round(time.time() - self.started, 3),
+                      'requests': self.requests, 'errors': self.errors,
+                      'retries': self.retries, 'throttled': self.throttled,
+                      'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                      'bytes_saved': self.bytes_saved,
+                      'latency_ms': {'p50': pct(0.5), 'p95': pct(0.95), 'max': pct(1),
+                                     'histogram': dict(zip(['<=%s' % b for b in latency_buckets] +
+                                                           ['>%s' % latency_buckets[-1]], hist))},
+                      'phases': dict([(name, {'seconds': round(sec, 3), 'requests': self.phase_requests[name]})
+                                      for name, sec in self.phases.items()]),
+                      'methods': dict([(name, {'calls': entry['calls'], 'requests': entry['requests'],
+                                               'seconds': round(entry['seconds'], 3)})
+                                       for name, entry in self.methods.items()])}
+            # Only runs that synced option lists have requests by list
+            if self.scopes:
+                report['option_lists'] = dict(self.scopes)
+            return report
+
+# Response hook counting every HTTP request made through a metered session
+def record_response(response, *args, **kwargs):
+    # Headers of the last response of the thread, e.g. for its Total-Count
+    metrics_local.headers = response.headers
+    m = getattr(metrics_local, 'metrics', None)
+    if m is None:
+        return
+    body = response.request.body
+    m.record_request(metrics_local.method, response.elapsed.total_seconds(),
+                     len(body) if body else 0, len(response.content), response.ok)
+
+# Wraps an IFB API object, recording every method call on metrics. Requests
+# are counted from the HTTP session of the wrapper, so paged reads count each
+# page; without a session each call is counted as one request
+class metered_api():
+    def __init__(self, api, metrics):
+        self.api = api
+        self.metrics = metrics
+        hooks = getattr(getattr(api, 'session', None), 'hooks', None)
+        self.http = hooks is not None
+        if self.http and record_response not in hooks['response']:
+            hooks['response'].append(record_response)
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            prev = (getattr(metrics_local, 'metrics', None), getattr(metrics_local, 'method', None))
+            metrics_local.metrics, metrics_local.method = self.metrics, name
+            start = time.time()
+            ok = False
+            try:
+                result = attr(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                metrics_local.metrics, metrics_local.method = prev
+                seconds = time.time() - start
+                self.metrics.record_call(name, seconds)
+                if not self.http:
+                    self.metrics.record_request(name, seconds, 0, 0, ok)
+        return call
+
+# HTTP statuses retried for any request: throttled, and server unavailable
+throttle_codes = [429, 503]
+# HTTP statuses and connection errors retried only for requests safe to repeat
+retry_codes = [500, 502, 504]
+idempotent_methods = ['GET', 'HEAD', 'PUT', 'DELETE']
+
+# Transport adapter scheduling the HTTP requests of an API session. A token
+# bucket keeps requests within rate_limit per second. The number of requests
+# in flight is unbounded until the server throttles; each throttle then
+# halves it and each successful request raises it by 1/window, so it grows by
+# about one per round of requests (AIMD). Throttled and failed requests are
+# retried after a jittered exponential backoff and the server's Retry-After,
+# and a request refused for an expired token is sent again with a new one
+class request_scheduler(requests.adapters.HTTPAdapter):
+    def __init__(self, session, rate_limit = 0, retry_limit = 5, refresh = None):
+        super().__init__()
+        self.session = session
+        self.rate_limit = rate_limit
+        self.retry_limit = retry_limit
+        # Function requesting a new access token, or None
+        self.refresh = refresh
+        self.cond = threading.Condition()
+        self.token_lock = threading.Lock()
+        self.tokens = max(rate_limit, 1)
+        self.refilled = time.time()
+        self.in_flight = 0
+        # Limit on requests in flight, None until the server first throttles
+        self.window = None
+        self.last_cut = 0
+
+    # Takes a token from the bucket, which holds up to one second of requests;
+    # returns seconds to wait if none is left
+    def take_token(self):
+        if self.rate_limit <= 0:
+            return 0
+        now = time.time()
+        self.tokens = min(max(self.rate_limit, 1), self.tokens + (now - self.refilled) * self.rate_limit)
+        self.refilled = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate_limit
+        self.tokens -= 1
+        return 0
+
+    # Waits for a free slot in the window and a token
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait = None
+                if self.window is None or self.in_flight < int(self.window):
+                    wait = self.take_token()
+                    if wait == 0:
+                        self.in_flight += 1
+                        return
+                self.cond.wait(wait)
+
+    # Frees a slot, cutting the window if the request was throttled; responses
+    # within a second of a cut were sent before it and do not cut it again
+    def release(self, throttled):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                now = time.time()
+                if now - self.last_cut > 1:
+                    level = self.in_flight + 1 if self.window is None else min(self.window, self.in_flight + 1)
+                    self.window = max(1.0, level / 2.0)
+                    self.last_cut = now
+            elif self.window is not None:
+                self.window += 1.0 / self.window
+            self.cond.notify_all()
+
+    # Seconds to wait before a retry: the server's Retry-After, if given, plus
+    # a random time up to an exponential ceiling, so that requests throttled
+    # together are not all sent again together
+    def backoff(self, attempt, response):
+        try:
+            wait = max(0.0, float(response.headers.get('Retry-After')))
+        except (AttributeError, TypeError, ValueError):
+            wait = 0.0
+        return wait + random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+
+    # Requests a new token, unless another request already did while this one
+    # was in flight, and puts it on the request
+    def refresh_token(self, request):
+        with self.token_lock:
+            if request.headers.get('Authorization') == self.session.headers.get('Authorization'):
+                print("     Access token expired, requesting a new one...")
+                self.refresh()
+            if self.session.headers.get('Authorization'):
+                request.headers['Authorization'] = self.session.headers['Authorization']
+
+    # Counts a response that is not returned, and reads and closes it so its
+    # connection goes back to the pool for the next attempt
+    def discard(self, response):
+        record_response(response)
+        response.content
+        response.close()
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        refreshes = 0
+        while True:
+            self.acquire()
+            start = time.time()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.release(False)
+                if request.method not in idempotent_methods or attempt >= self.retry_limit:
+                    raise
+                response = None
+            else:
+                response.elapsed = datetime.timedelta(seconds = time.time() - start)
+                throttled = response.status_code in throttle_codes
+                self.release(throttled)
+                if (response.status_code == 401 and self.refresh is not None
+                        and '/oauth/' not in request.url and refreshes < self.retry_limit):
+                    refreshes += 1
+                    self.discard(response)
+                    self.refresh_token(request)
+                    continue
+                if not (throttled or (response.status_code in retry_codes and request.method in idempotent_methods)) \
+                        or attempt >= self.retry_limit:
+                    return response
+                # The hooks of the session only see the final response
+                self.discard(response)
+            attempt += 1
+            m = getattr(metrics_local, 'metrics', None)
+            if m is not None:
+                m.record_retry(response is not None and response.status_code in throttle_codes)
+            time.sleep(self.backoff(attempt, response))
+
+# Mounts a request scheduler on the HTTP session of an API object, or tightens
+# the one mounted by an earlier sync sharing the session to the lowest rate
+# limit; does nothing for API objects without a session
+def schedule_api(api, rate_limit, retry_limit):
+    session = getattr(api, 'session', None)
+    if session is None or not hasattr(session, 'mount'):
+        return
+    sched = session.get_adapter('https://')
+    if getattr(sched, 'scheduler', False):
+        if rate_limit > 0 and (sched.rate_limit <= 0 or rate_limit < sched.rate_limit):
+            sched.rate_limit = rate_limit
+        sched.retry_limit = max(sched.retry_limit, retry_limit)
+        return
+    sched = request_scheduler(session, rate_limit, retry_limit, getattr(api, 'requestAccessToken', None))
+    sched.scheduler = True
+    session.mount('https://', sched)
+    session.mount('http://', sched)
+
+# Writes the metrics report as JSON, or as CSV rows of section, name, metric
+# and value
+def write_metrics(report, path):
+    if os.path.splitext(path)[1].lower() == '.json':
+        with open(path, 'w') as f:
+            json.dump(report, f, indent = 2)
+        return
+    rows = [('run', 'total', key, report[key]) for key in
+            ['started', 'seconds', 'requests', 'errors', 'retries', 'throttled',
+             'bytes_sent', 'bytes_received', 'bytes_saved']]
+    rows += [('latency_ms', 'total', key, report['latency_ms'][key]) for key in ['p50', 'p95', 'max']]
+    rows += [('latency_ms', bucket, 'requests', n) for bucket, n in report['latency_ms']['histogram'].items()]
+    for section in ['phases', 'methods']:
+        for name, values in report[section].items():
+            rows += [(section[:-1], name, key, value) for key, value in values.items()]
+    rows += [('option_list', name, 'requests', n) for name, n in report.get('option_lists', {}).items()]
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['section', 'name', 'metric', 'value'])
+        writer.writerows(rows)
+
+# Prints a summary table of the metrics report
+def print_metrics(report):
+    print()
+    print("%-16s %9s %9s" % ('Phase', 'Seconds', 'Requests'))
+    for name, values in report['phases'].items():
+        print("%-16s %9.2f %9s" % (name, values['seconds'], values['requests']))
+    print()
+    print("%-20s %7s %9s %9s" % ('API method', 'Calls', 'Requests', 'Seconds'))
+    for name, values in report['methods'].items():
+        print("%-20s %7s %9s %9.2f" % (name, values['calls'], values['requests'], values['seconds']))
+    print()
+    lat = report['latency_ms']
+    print("%s requests (%s failed), %.1f KB sent, %.1f KB received in %.1f seconds." %
+            (report['requests'], report['errors'], report['bytes_sent'] / 1024.0,
+             report['bytes_received'] / 1024.0, report['seconds']))
+    if report['bytes_saved'] > 0:
+        print("%.1f KB of unchanged fields left out of update payloads." % (report['bytes_saved'] / 1024.0))
+    if report['retries'] > 0:
+        print("%s requests retried, %s of them throttled by the server." % (report['retries'], report['throttled']))
+    print("Request latency ms: p50 %s, p95 %s, max %s" % (lat['p50'], lat['p95'], lat['max']))
+    print("  " + "  ".join(["%s: %s" % (bucket, n) for bucket, n in lat['histogram'].items()]))
+    print()
+
+# Ends the run metrics, writing and printing them as set in the INI file;
+# returns the number of API requests made
+def finish_metrics(m, settings):
+    m.phase()
+    report = m.report()
+    if settings.metrics_file:
+        write_metrics(report, os.path.join(settings.cur_dir, settings.metrics_file))
+    if settings.metrics_summary:
+        print_metrics(report)
+    return report['requests']
+
+# Lock keeping console output from worker threads on separate lines
+print_lock = threading.Lock()
+
+# Prints one line per target
+def target_summary(targets):
+    width = max([len(t.name) for t in targets] + [6])
+    print("%s  Server                Profile  Status   Calls  Seconds  Error" % 'Target'.ljust(width))
+    for t in targets:
+        print("%s  %s  %7s  %s  %5s  %7.1f  %s" % ((t.name or '[API]').ljust(width), t.server_name.ljust(20),
+              t.profile_id, t.status.ljust(7), t.calls if t.calls is not None else '-', t.seconds, t.error))
@@ -10,44 +10,79 @@
 #-------------------------------------------------------------------------------
 from ifb import IFB
 import configparser
-import pandas as pd
+import copy
+import csv
+import re
+import sqlite3
+import json
+import time
 import os
 import sys
-import math
-
-print()
-print("-----------------------------------------------------------------------")
-print("iFormBuilder Lookup Form Syncer")
-print("Created by Bill DeVoe, 2020. Distributed under MIT License")
-print("For questions, see the included documentation.")
-print("Contact: william.devoe@maine.gov or bdevoe@gmail.com")
-print("-----------------------------------------------------------------------")
-print()
-
-# Get current directory from command line
-try:
-    cur_dir = sys.argv[1]
-    #cur_dir = os.path.dirname(__file__)
-except:
-    sys.exit(("The program directory was either not provided or does not exist."
-    "Please provide program directory as command line argument."))
-
-if os.path.exists(cur_dir):
-    print("Running from directory: %s" % (os.path.basename(cur_dir)))
-else:
-    sys.exit(("The program directory was either not provided or does not exist."
-    "Please provide program directory as command line argument."))
-
-try:
-    config_fn = sys.argv[2]
-    #config_fn = 'settings_o.ini'
-except:
-    config_fn = "config.ini"
-    print("Config file name not provided, defaulting to config.ini...")
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Code shared with the option list syncer lives in the common directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+from ifb_common import (target, target_settings, target_summary, file_stem, file_hash, metrics,
+                        metrics_local, metered_api, schedule_api, finish_metrics, print_lock)
+
+# pandas and numpy are imported by load_pandas() when first needed, so runs
+# on small tables and runs with nothing to push do not pay their start-up
+pd = None
+np = None
+
+# Imports pandas and numpy into the module namespace
+def load_pandas():
+    global pd, np
+    if pd is None:
+        import pandas
+        import numpy
+        pd, np = pandas, numpy
+
+# Prints the program banner
+def print_banner():
+    print()
+    print("-----------------------------------------------------------------------")
+    print("iFormBuilder Lookup Form Syncer")
+    print("Created by Bill DeVoe, 2020. Distributed under MIT License")
+    print("For questions, see the included documentation.")
+    print("Contact: william.devoe@maine.gov or bdevoe@gmail.com")
+    print("-----------------------------------------------------------------------")
+    print()
+
+# Gets the program directory, INI file name and --full flag from the command line
+def parse_args():
+    # Flags may be given anywhere after the program name
+    args = [arg for arg in sys.argv if not arg.startswith('--')]
+    full_sync = '--full' in sys.argv
+    resume = '--resume' in sys.argv
+    try:
+        cur_dir = args[1]
+        #cur_dir = os.path.dirname(__file__)
+    except:
+        sys.exit(("The program directory was either not provided or does not exist."
+        "Please provide program directory as command line argument."))
+
+    if os.path.exists(cur_dir):
+        print("Running from directory: %s" % (os.path.basename(cur_dir)))
+    else:
+        sys.exit(("The program directory was either not provided or does not exist."
+        "Please provide program directory as command line argument."))
+
+    try:
+        config_fn = args[2]
+        #config_fn = 'settings_o.ini'
+    except:
+        config_fn = "config.ini"
+        print("Config file name not provided, defaulting to config.ini...")
+    return cur_dir, config_fn, full_sync, resume
 
 # Class handler to parse INI file
 class settings():
-    def __init__(self):
+    def __init__(self, cur_dir, config_fn):
+        self.cur_dir = cur_dir
+        self.config_fn = config_fn
         configfile = os.path.join(cur_dir, config_fn)
         if os.path.exists(configfile) != True:
             sys.exit(("Configuration file could not be found. "
@@ -77,6 +112,21 @@ class settings():
             self.ifb_secret = config.get("API", "ifb_secret")
         except:
             sys.exit("INI file is missing ifb_secret option.")
+        # Destinations synced from the CSV: the [API] server and profile, and
+        # optional [Targets], one per line as
+        # name: server_name, profile_id[, ifb_key, ifb_secret]
+        self.target = ''
+        self.targets = [target('', self.server_name, self.profile_id, self.ifb_key, self.ifb_secret)]
+        if config.has_section("Targets"):
+            for name, value in config.items("Targets"):
+                parts = [part.strip() for part in value.split(',')]
+                if len(parts) == 2:
+                    parts += [self.ifb_key, self.ifb_secret]
+                try:
+                    self.targets.append(target(name, parts[0], int(parts[1]), parts[2], parts[3]))
+                except (IndexError, ValueError):
+                    sys.exit(("INI Targets option %s must be server_name, profile_id or "
+                              "server_name, profile_id, ifb_key, ifb_secret." % name))
         ## Parse Form options
         # CSV file name
         try:
@@ -108,17 +158,137 @@ class settings():
         except:
             self.has_uid = False
         # Optional update flag
+        self.update = False
         try:
             if self.has_uid:
                 self.update = config.getboolean("Form", "update")
         except:
             pass
         # Optional delete flag
+        self.delete = False
         try:
             if self.has_uid:
                 self.delete = config.getboolean("Form", "delete")
         except:
             pass
+        # Optional flag to keep a local snapshot of IFB page state between syncs
+        self.snapshot = False
+        try:
+            if self.has_uid:
+                self.snapshot = config.getboolean("Form", "snapshot")
+        except:
+            pass
+        # Optional flag to skip unchanged source files and push only changed
+        # rows, which needs the snapshot when using a unique ID column
+        try:
+            self.incremental = config.getboolean("Form", "incremental")
+        except:
+            self.incremental = False
+        if self.incremental and self.has_uid:
+            self.snapshot = True
+        # Optional number of records removed per bulk delete call; the record
+        # ids are sent in the URL, which servers and proxies limit to about
+        # 8 KB, so at most 200 ids are sent per call
+        try:
+            self.delete_chunk_size = config.getint("Form", "delete_chunk_size")
+        except:
+            self.delete_chunk_size = 100
+        if self.delete_chunk_size < 1 or self.delete_chunk_size > 200:
+            sys.exit("INI delete_chunk_size option must be between 1 and 200.")
+        ## Optional Performance options
+        # Number of chunks uploaded concurrently
+        try:
+            self.workers = config.getint("Performance", "workers")
+        except:
+            self.workers = 1
+        if self.workers < 1:
+            sys.exit("INI workers option must be 1 or greater.")
+        # Number of records sent per upload call
+        try:
+            self.chunk_size = config.getint("Performance", "chunk_size")
+        except:
+            self.chunk_size = 1000
+        if self.chunk_size < 1 or self.chunk_size > 1000:
+            sys.exit("INI chunk_size option must be between 1 and 1000.")
+        # Memory ceiling in MB for source data; the CSV is read in chunks if set
+        try:
+            self.memory_mb = config.getint("Performance", "memory_mb")
+        except:
+            self.memory_mb = 0
+        # CSVs of at most this many rows are synced without pandas
+        try:
+            self.fast_path_rows = config.getint("Performance", "fast_path_rows")
+        except:
+            self.fast_path_rows = 1000
+        if self.fast_path_rows < 0:
+            sys.exit("INI fast_path_rows option must be 0 or greater.")
+        # Requests per second allowed by the server, 0 for no limit
+        try:
+            self.rate_limit = config.getfloat("Performance", "rate_limit")
+        except:
+            self.rate_limit = 0
+        if self.rate_limit < 0:
+            sys.exit("INI rate_limit option must be 0 or greater.")
+        # Times a throttled or failed request is retried
+        try:
+            self.max_retries = config.getint("Performance", "max_retries")
+        except:
+            self.max_retries = 5
+        if self.max_retries < 0:
+            sys.exit("INI max_retries option must be 0 or greater.")
+        # Optional file the run metrics are written to, as .json or .csv
+        try:
+            self.metrics_file = config.get("Performance", "metrics_file")
+        except:
+            self.metrics_file = None
+        if self.metrics_file and os.path.splitext(self.metrics_file)[1].lower() not in ['.json', '.csv']:
+            sys.exit("INI metrics_file option must name a .json or .csv file.")
+        # Optional flag to print a summary of the run metrics
+        try:
+            self.metrics_summary = config.getboolean("Performance", "metrics_summary")
+        except:
+            self.metrics_summary = False
+        # Optional format of the input file, by default from its extension
+        try:
+            self.source_format = config.get("Form", "source_format").lower()
+        except:
+            self.source_format = source_extensions.get(os.path.splitext(self.csv_in)[1].lower(), 'csv')
+        if self.source_format not in source_readers:
+            sys.exit("INI source_format option must be one of %s." % ', '.join(sorted(source_readers)))
+        # Optional table of an SQLite input file
+        try:
+            self.source_table = config.get("Form", "source_table")
+        except:
+            self.source_table = None
+        # Optional flag to read CSV number and True/False columns as typed
+        # values, as versions before reading every column as text did
+        try:
+            self.infer_types = config.getboolean("Form", "infer_types")
+        except:
+            self.infer_types = False
+        # Optional number of pages the source is split across, as shards
+        try:
+            self.shards = config.getint("Form", "shards")
+        except:
+            self.shards = 1
+        if self.shards < 1:
+            sys.exit("INI shards option must be 1 or greater.")
+        if self.shards > 1 and not self.has_uid:
+            sys.exit("INI shards option needs the uid_col option.")
+        # Column the shard of each row is taken from, by default the unique ID
+        try:
+            self.shard_col = config.get("Form", "shard_col")
+        except:
+            self.shard_col = self.uid_col if self.has_uid else None
+        # Whether rows are sharded by a hash or by ranges of the shard column
+        try:
+            self.shard_by = config.get("Form", "shard_by").lower()
+        except:
+            self.shard_by = 'hash'
+        if self.shard_by not in ['hash', 'range']:
+            sys.exit("INI shard_by option must be hash or range.")
+        # Unique IDs of every source row, set when syncing a shard
+        self.shard_uids = None
 
 def reserved_dcn_check(dcns):
     # List of reserved column names in IFB
@@ -136,51 +306,309 @@ def reserved_dcn_check(dcns):
             print("     %s" % r)
         sys.exit()
 
-# Loads CSV to Pandas dataframe
-def load_csv(csv_in):
-    # Read CSV
-    df = pd.read_csv(os.path.join(cur_dir, csv_in), na_filter = False)
-    # All columns to string
-    df = df.astype(str)
+# Cleans up a messy column name
+def clean_column(name):
+    return re.sub(r'[^\w\s]', '', name.strip().lower().replace(' ', '_'))
+
+# Cleans up messy column names
+def clean_columns(columns):
+    return pd.Index([clean_column(col) for col in columns])
+
+# Normalizes a chunk of CSV data read as text
+def normalize_chunk(df, settings):
     # Cleanup messy column names
-    df.columns = df.columns.str.strip().str.lower().str.replace(' ', '_').str.replace('[^\w\s]','')
+    df.columns = clean_columns(df.columns)
     # Truncate data to field length
     for col in df.columns:
-        df[col] = df[col].str[:s.field_length]
+        df[col] = df[col].str[:settings.field_length]
+    return df
+
+# Reads a CSV with every column as text as written, or with settings
+# infer_types, as the text of the values pandas infers, e.g. 7 for 007 and
+# 1.5 for 1.50; returns a reader of chunks if chunksize is given
+def read_csv_text(path, settings, **kwargs):
+    if not settings.infer_types:
+        return pd.read_csv(path, dtype = str, na_filter = False, **kwargs)
+    reader = pd.read_csv(path, na_filter = False, **kwargs)
+    if kwargs.get('chunksize') is None:
+        return reader.astype(str)
+    return (chunk.astype(str) for chunk in reader)
+
+# Loads CSV to Pandas dataframe
+def load_csv(csv_in, settings):
+    # Read CSV, all columns as text
+    df = read_csv_text(os.path.join(settings.cur_dir, csv_in), settings)
+    df = normalize_chunk(df, settings)
     # Check for reserved column names
     reserved_dcn_check(df.columns)
     return df
 
+# Loads a CSV of at most max_rows rows as lists of text values with the csv
+# module, normalized as load_csv does; returns None, leaving the CSV to
+# load_csv, if it has more rows or anything pandas would read differently
+def load_csv_rows(csv_in, settings, max_rows):
+    rows = list()
+    try:
+        with open(os.path.join(settings.cur_dir, csv_in), newline = '', encoding = 'utf-8-sig') as f:
+            # Lines of the file read for the current row
+            lines = list()
+            def read_lines():
+                for line in f:
+                    lines.append(line)
+                    yield line
+            reader = csv.reader(read_lines())
+            header = next(reader, None)
+            # pandas names blank and duplicate columns itself
+            if not header or '' in header or len(set(header)) < len(header):
+                return None
+            del lines[:]
+            for row in reader:
+                # pandas skips blank lines and lines of only spaces and tabs,
+                # but not quoted blanks
+                blank = len(lines) == 1 and lines[0].strip(' \t\r\n') == ''
+                del lines[:]
+                if blank:
+                    continue
+                if len(rows) == max_rows or len(row) > len(header):
+                    return None
+                # Missing trailing values are blank, as with pandas
+                row = row + [''] * (len(header) - len(row))
+                rows.append([val[:settings.field_length] for val in row])
+    except (csv.Error, UnicodeDecodeError):
+        return None
+    dcns = [clean_column(col) for col in header]
+    # Check for reserved column names
+    reserved_dcn_check(dcns)
+    return dcns, rows
+
+## Source readers
+# Each reader lists the columns of the input file and reads any of them as
+# text, all at once or in chunks of rows, so only the columns present on the
+# page are read
+
+# Converts the columns of a typed source to text as pandas writes them to a
+# CSV: whole numbers without a decimal point, missing values blank, and dates
+# and times in ISO format
+def text_frame(df):
+    text = dict()
+    for col in df.columns:
+        values = df[col]
+        blank = values.isna().to_numpy()
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = values.dt.strftime('%Y-%m-%d %H:%M:%S')
+        arr = values.astype(str).to_numpy(dtype = object)
+        arr[blank] = ''
+        text[col] = arr
+    return pd.DataFrame(text, index = df.index)
+
+# Converts an Arrow table or record batch to text, keeping integer and
+# boolean columns with missing values as whole numbers and True/False
+def arrow_frame(data):
+    import pyarrow as pa
+    types = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int32(): pd.Int32Dtype(),
+             pa.int64(): pd.Int64Dtype(), pa.uint8(): pd.UInt8Dtype(), pa.uint16(): pd.UInt16Dtype(),
+             pa.uint32(): pd.UInt32Dtype(), pa.uint64(): pd.UInt64Dtype(), pa.bool_(): pd.BooleanDtype()}
+    return text_frame(data.to_pandas(types_mapper = types.get))
+
+# Class reading a CSV input file, with every column read as text as written
+class csv_source():
+    def __init__(self, settings):
+        self.settings = settings
+        self.path = os.path.join(settings.cur_dir, settings.csv_in)
+
+    # Column names as written in the file
+    def columns(self):
+        return list(pd.read_csv(self.path, nrows = 0).columns)
+
+    # Yields the columns cols as text, in chunks of chunk_rows rows, or in one
+    # piece if chunk_rows is None
+    def read(self, cols, chunk_rows = None):
+        keep = set(cols)
+        reader = read_csv_text(self.path, self.settings, usecols = lambda col: col in keep, chunksize = chunk_rows)
+        return [reader] if chunk_rows is None else reader
+
+# Class reading a Parquet input file with pyarrow, one row group at a time
+# when read in chunks
+class parquet_source():
+    def __init__(self, settings):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            sys.exit("ERROR: Reading Parquet input files needs the pyarrow package.")
+        self.file = pyarrow.parquet.ParquetFile(os.path.join(settings.cur_dir, settings.csv_in))
+
+    def columns(self):
+        return list(self.file.schema_arrow.names)
+
+    def read(self, cols, chunk_rows = None):
+        if chunk_rows is None:
+            yield arrow_frame(self.file.read(columns = cols))
+            return
+        for batch in self.file.iter_batches(batch_size = chunk_rows, columns = cols):
+            yield arrow_frame(batch)
+
+# Class reading a Feather (Arrow IPC) input file with pyarrow; the file is
+# memory mapped, and when read in chunks, only the columns read of one
+# record batch at a time are loaded
+class feather_source():
+    def __init__(self, settings):
+        try:
+            import pyarrow
+            import pyarrow.feather
+            import pyarrow.ipc
+        except ImportError:
+            sys.exit("ERROR: Reading Feather input files needs the pyarrow package.")
+        self.pa = pyarrow
+        self.path = os.path.join(settings.cur_dir, settings.csv_in)
+
+    # Reader of the record batches of the file, holding the columns cols
+    def reader(self, cols = None):
+        options = None
+        if cols is not None:
+            names = self.columns()
+            options = self.pa.ipc.IpcReadOptions(included_fields = [names.index(col) for col in cols])
+        return self.pa.ipc.open_file(self.pa.memory_map(self.path), options = options)
+
+    def columns(self):
+        try:
+            return list(self.pa.ipc.open_file(self.pa.memory_map(self.path)).schema.names)
+        except self.pa.ArrowInvalid:
+            # Version 1 Feather files are not Arrow IPC files
+            return list(self.pa.feather.read_table(self.path, memory_map = True).schema.names)
+
+    def read(self, cols, chunk_rows = None):
+        try:
+            reader = self.reader(cols)
+        except self.pa.ArrowInvalid:
+            reader = None
+        if chunk_rows is None or reader is None:
+            yield arrow_frame(self.pa.feather.read_table(self.path, columns = cols, memory_map = True))
+            return
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for start in range(0, batch.num_rows, chunk_rows):
+                yield arrow_frame(batch.slice(start, chunk_rows))
+
+# Quotes an SQLite identifier
+def sql_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+# Class reading a table or view of an SQLite input file, named by the
+# source_table setting, or the only table in the file
+class sqlite_source():
+    def __init__(self, settings):
+        self.path = os.path.join(settings.cur_dir, settings.csv_in)
+        con = sqlite3.connect(self.path)
+        try:
+            tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")]
+        except sqlite3.Error as e:
+            sys.exit("ERROR: Input file %s could not be read as SQLite: %s" % (settings.csv_in, e))
+        finally:
+            con.close()
+        self.table = settings.source_table
+        if self.table is None and len(tables) == 1:
+            self.table = tables[0]
+        if self.table not in tables:
+            sys.exit("ERROR: INI source_table option must name one of the tables in %s: %s" %
+                        (settings.csv_in, ', '.join(tables)))
+
+    # Names and declared types of the columns of the table
+    def schema(self):
+        con = sqlite3.connect(self.path)
+        try:
+            return [(row[1], row[2]) for row in con.execute("PRAGMA table_info(%s)" % sql_name(self.table))]
+        finally:
+            con.close()
+
+    def columns(self):
+        return [name for name, decl in self.schema()]
+
+    def read(self, cols, chunk_rows = None):
+        # Columns declared as integers are read as floats where they hold NULLs
+        ints = [name for name, decl in self.schema() if name in cols and 'INT' in decl.upper()]
+        con = sqlite3.connect(self.path)
+        try:
+            query = "SELECT %s FROM %s" % (', '.join([sql_name(col) for col in cols]), sql_name(self.table))
+            frames = pd.read_sql_query(query, con, chunksize = chunk_rows)
+            for frame in ([frames] if chunk_rows is None else frames):
+                for col in ints:
+                    try:
+                        frame[col] = frame[col].astype('Int64')
+                    except (TypeError, ValueError):
+                        # Text stored in an integer column
+                        pass
+                yield text_frame(frame)
+        finally:
+            con.close()
+
+# Source readers by input file format, and the format of each file extension;
+# other extensions are read as CSV
+source_readers = {'csv': csv_source, 'parquet': parquet_source, 'feather': feather_source, 'sqlite': sqlite_source}
+source_extensions = {'.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather', '.arrow': 'feather',
+                     '.sqlite': 'sqlite', '.sqlite3': 'sqlite', '.db': 'sqlite'}
+
+# Number of rows per chunk that keeps a chunk of source data, and the
+# payloads built from it, within the settings.memory_mb ceiling, estimated
+# from a sample of rows of the columns cols
+def chunk_rows(reader, cols, settings):
+    sample = next(iter(reader.read(cols, 1000)), None)
+    if sample is None or len(sample.index) == 0:
+        return 1000
+    row_bytes = sample.memory_usage(index = False, deep = True).sum() / len(sample.index)
+    # A quarter of the ceiling for the chunk, the rest for payloads and state
+    return max(int(settings.memory_mb * 1024 * 1024 / 4 / max(row_bytes, 1)), 100)
+
+# Builds IFB record bodies straight from the dataframe column arrays, yielding
+# lists of at most chunk_size records; with_id adds the id column as record id
+def iter_record_bodies(df, chunk_size = 1000, with_id = False):
+    dcns = [dcn for dcn in df.columns if dcn != 'id']
+    arrays = [df[dcn].to_numpy() for dcn in dcns]
+    if with_id:
+        ids = df['id'].to_numpy()
+    nrow = len(df.index)
+    for start in range(0, nrow, chunk_size):
+        end = min(start + chunk_size, nrow)
+        rows = zip(*[arr[start:end].tolist() for arr in arrays])
+        flds = [[{'element_name': dcn, 'value': val} for dcn, val in zip(dcns, row)]
+                for row in rows]
+        if with_id:
+            yield [{'id': rid, 'fields': fld} for rid, fld in zip(ids[start:end].tolist(), flds)]
+        else:
+            yield [{'fields': fld} for fld in flds]
+
+# Builds IFB record bodies from lists of row values as iter_record_bodies
+# does, yielding lists of at most chunk_size records; ids are the record ids
+# of rows to update
+def iter_row_bodies(dcns, rows, chunk_size = 1000, ids = None):
+    for start in range(0, len(rows), chunk_size):
+        flds = [[{'element_name': dcn, 'value': val} for dcn, val in zip(dcns, row)]
+                for row in rows[start:start + chunk_size]]
+        if ids is not None:
+            yield [{'id': rid, 'fields': fld} for rid, fld in zip(ids[start:start + chunk_size], flds)]
+        else:
+            yield [{'fields': fld} for fld in flds]
+
 # Converts a dataframe to the IFB format for inserting records
 def df_to_ifb(df):
-    dcns = list(df.columns)
     parsed = list()
-    for index, row in df.iterrows():
-        flds = list()
-        for dcn in dcns:
-            flds.append({'element_name': dcn, 'value': row[dcn]})
-        parsed.append({'fields': flds})
+    for body in iter_record_bodies(df):
+        parsed.extend(body)
     return parsed
 
 # Converts a dataframe to the IFB format for updating records
 def df_to_ifb_u(df):
-    dcns = list(df.columns)
-    if 'id' not in dcns:
+    if 'id' not in df.columns:
         sys.exit("ERROR: id column is missing from update data.")
     parsed = list()
-    for index, row in df.iterrows():
-        flds = list()
-        for dcn in dcns:
-            if dcn == 'id':
-                continue
-            flds.append({'element_name': dcn, 'value': row[dcn]})
-        parsed.append({'id': row['id'], 'fields': flds})
+    for body in iter_record_bodies(df, with_id = True):
+        parsed.extend(body)
     return parsed
 
 # Converts a dictionary of IFB records to a Pandas df
-def ifb_to_df(ifb_dict):
+def ifb_to_df(ifb_dict, flds = None):
     # Get field names from keys of first record
-    flds = ifb_dict[0].keys()
+    if flds is None:
+        flds = ifb_dict[0].keys()
     # Blank dictionary
     df_dict = {}
     # For each key, make a list of all the data for that field and append to dict
@@ -190,90 +618,1091 @@ def ifb_to_df(ifb_dict):
     df = pd.DataFrame.from_dict(df_dict)
     return df
 
-# Send a dataframe of records to IFB, in chunks if over the API limit
-def send_records(df, api, settings):
-    # If less than 1000 records push all
-        if len(df.index) < 1000:
-            api.createRecords(settings.profile_id, settings.page_id,
-                                body = df_to_ifb(df))
-        # Else push records in chunks
+# Hashes each row of the given columns to a single 64 bit fingerprint; data
+# is normalized to text first so CSV and API values of the same row match
+def row_fingerprints(df, cols):
+    norm = df[cols].fillna('').astype(str)
+    return pd.util.hash_pandas_object(norm, index = False).values
+
+# Hashes each value of the given columns to a 32 bit fingerprint, as columns
+# f0, f1, ... in the order of cols, used to find the fields of a changed row
+# that differ
+def field_fingerprints(df, cols):
+    norm = df[cols].fillna('').astype(str)
+    return dict([('f%s' % i, (pd.util.hash_pandas_object(norm[col], index = False).values
+                              & np.uint64(0xffffffff)).astype('uint32'))
+                 for i, col in enumerate(cols)])
+
+# Names of the field fingerprint columns of a state, in column order
+def field_columns(state):
+    return [col for col in state.columns if col[0] == 'f' and col[1:].isdigit()]
+
+# Builds the state of IFB records used for diffing: record id, unique ID and
+# fingerprint of the compared columns, and if fields, field fingerprints
+def remote_state(ifb_df, uid_col, cols, fields = False):
+    state = {'id': ifb_df['id'].astype(object).values,
+             'uid': ifb_df[uid_col].fillna('').astype(str).values,
+             'fp': row_fingerprints(ifb_df, cols)}
+    if fields:
+        state.update(field_fingerprints(ifb_df, cols))
+    return pd.DataFrame(state)
+
+# Builds the state of source rows used for diffing from chunks of source
+# data: unique ID and fingerprint of the compared columns, and if fields,
+# field fingerprints, in row order
+def source_state(chunks, uid_col, cols, fields = False):
+    parts = list()
+    for chunk in chunks:
+        part = {'uid': chunk[uid_col].astype(str).values, 'fp': row_fingerprints(chunk, cols)}
+        if fields:
+            part.update(field_fingerprints(chunk, cols))
+        parts.append(pd.DataFrame(part))
+    if len(parts) == 0:
+        empty = {'uid': pd.Series(dtype = str), 'fp': pd.Series(dtype = 'uint64')}
+        if fields:
+            empty.update([('f%s' % i, pd.Series(dtype = 'uint32')) for i in range(len(cols))])
+        return pd.DataFrame(empty)
+    return pd.concat(parts, ignore_index = True)
+
+# Class holding the records to append, update and delete in a sync
+class changeset():
+    def __init__(self, source, append, update, update_ids, delete, unchanged, update_fields = None):
+        # Source state the changeset was computed from
+        self.source = source
+        # Positions of source rows with no matching unique ID in IFB
+        self.append = append
+        # Positions of source rows differing from IFB, and their IFB record ids
+        self.update = update
+        self.update_ids = update_ids
+        # IFB record ids with no matching unique ID in the source
+        self.delete = delete
+        # Count of rows identical in source and IFB
+        self.unchanged = unchanged
+        # For each row to update, a bit mask of the compared columns that
+        # changed, or None if not known
+        self.update_fields = update_fields
+
+# Classifies source rows against the IFB remote state in a single pass,
+# looking up unique IDs in a hashed index and comparing row fingerprints
+def diff_state(source, state):
+    src_fp = source['fp'].to_numpy()
+    src_uids = pd.Index(source['uid'])
+    # Only the first IFB record is matched where unique IDs are duplicated
+    ifb = state.drop_duplicates(subset = 'uid')
+    ifb_index = pd.Index(ifb['uid'])
+    loc = ifb_index.get_indexer(src_uids)
+    found = loc >= 0
+    changed = np.zeros(len(loc), dtype = bool)
+    changed[found] = src_fp[found] != ifb['fp'].to_numpy()[loc[found]]
+    delete = ifb.loc[~ifb_index.isin(src_uids), 'id'].tolist()
+    # Bit masks of the changed fields, if both states have field fingerprints
+    masks = None
+    fcols = field_columns(source)
+    if len(fcols) > 0 and fcols == field_columns(ifb):
+        masks = np.zeros(int(changed.sum()), dtype = object)
+        for i, col in enumerate(fcols):
+            diff = source[col].to_numpy()[changed] != ifb[col].to_numpy()[loc[changed]]
+            masks[diff] += 1 << i
+    return changeset(source, np.flatnonzero(~found), np.flatnonzero(changed),
+                     ifb['id'].to_numpy()[loc[changed]], delete,
+                     int(found.sum() - changed.sum()), masks)
+
+# Text of an IFB record value, as compared by row_fingerprints
+def value_text(val):
+    return '' if val is None else str(val)
+
+# Classifies lists of source row values against IFB records as diff_state
+# does, comparing the text of the compared columns instead of fingerprints
+def diff_rows(dcns, rows, ifb_records, uid_col, cols):
+    uid_pos = dcns.index(uid_col)
+    col_pos = [dcns.index(col) for col in cols]
+    # Only the first IFB record is matched where unique IDs are duplicated
+    ifb = dict()
+    for record in ifb_records:
+        uid = value_text(record[uid_col])
+        if uid not in ifb:
+            ifb[uid] = (record['id'], tuple([value_text(record[col]) for col in cols]))
+    append, update, update_ids, masks = list(), list(), list(), list()
+    unchanged = 0
+    for pos, row in enumerate(rows):
+        match = ifb.get(row[uid_pos])
+        if match is None:
+            append.append(pos)
+            continue
+        values = tuple([row[i] for i in col_pos])
+        if values != match[1]:
+            update.append(pos)
+            update_ids.append(match[0])
+            masks.append(sum([1 << i for i, (src, ifb_val) in enumerate(zip(values, match[1]))
+                              if src != ifb_val]))
         else:
-            nrow = len(df.index)
-            # Iterate over in chunks of 999
-            print("More than 1000 rows in data, uploading in chunks...")
-            start = 0
-            end = 999
+            unchanged += 1
+    src_uids = set([row[uid_pos] for row in rows])
+    delete = [match[0] for uid, match in ifb.items() if uid not in src_uids]
+    return changeset(None, append, update, update_ids, delete, unchanged, masks)
+
+# Yields, for each chunk of source data, the rows to append, the rows to
+# update with their IFB record id in column id, and the changed field masks
+# of the rows to update, or None if not known
+def changed_rows(chunks, changes):
+    nrow = len(changes.source.index)
+    is_append = np.zeros(nrow, dtype = bool)
+    is_append[changes.append] = True
+    is_update = np.zeros(nrow, dtype = bool)
+    is_update[changes.update] = True
+    update_ids = np.empty(nrow, dtype = object)
+    update_ids[changes.update] = changes.update_ids
+    update_fields = None
+    if changes.update_fields is not None:
+        update_fields = np.zeros(nrow, dtype = object)
+        update_fields[changes.update] = changes.update_fields
+    start = 0
+    for chunk in chunks:
+        end = start + len(chunk.index)
+        append = chunk[is_append[start:end]]
+        update = chunk[is_update[start:end]].copy()
+        update['id'] = update_ids[start:end][is_update[start:end]]
+        masks = None if update_fields is None else update_fields[start:end][is_update[start:end]]
+        start = end
+        yield append, update, masks
+
+# Groups rows to update by the set of fields that changed, as (mask, row
+# positions) pairs in mask order; a mask of 0, from fingerprints colliding,
+# and unknown masks stand for all ncols fields
+def field_groups(masks, ncols, nrow):
+    full = (1 << ncols) - 1
+    if masks is None:
+        return [(full, list(range(nrow)))]
+    groups = dict()
+    for pos, mask in enumerate(masks):
+        groups.setdefault(int(mask) or full, []).append(pos)
+    return sorted(groups.items())
+
+# Columns of cols whose bit is set in mask
+def mask_fields(mask, cols):
+    return [col for i, col in enumerate(cols) if mask >> i & 1]
+
+# Bytes of the fields of column col holding values in a JSON record body, as
+# sent when every field of a record was updated
+def field_bytes(col, values):
+    if len(values) == 0:
+        return 0
+    # Encoded values, without the brackets and separators of the list
+    encoded = len(json.dumps(values)) - 2 - 2 * (len(values) - 1)
+    return encoded + len(values) * len('{"element_name": %s, "value": }, ' % json.dumps(col))
+
+# Latest modified_date of a list of IFB records, or default if none
+def max_modified(ifb_records, default):
+    dates = [record['modified_date'] for record in ifb_records if record.get('modified_date')]
+    return max(dates + [default])
+
+# Path of the local snapshot of IFB page state, stored next to the INI file
+def snapshot_path(settings):
+    return os.path.join(settings.cur_dir, file_stem(settings) + '_snapshot.sqlite')
+
+# Loads the IFB page state saved by the last successful sync; returns None if
+# there is no snapshot or it was taken for a different page or columns
+def load_snapshot(settings, cols):
+    path = snapshot_path(settings)
+    if not os.path.exists(path):
+        return None
+    con = sqlite3.connect(path)
+    try:
+        meta = dict(con.execute("SELECT key, value FROM meta").fetchall())
+        if (meta.get('page_id') != str(settings.page_id) or meta.get('uid_col') != settings.uid_col
+                or meta.get('columns') != ','.join(cols)):
+            print("     Snapshot does not match page or columns, ignoring...")
+            return None
+        state = pd.read_sql_query("SELECT * FROM records", con)
+    except (sqlite3.Error, pd.errors.DatabaseError):
+        print("     Snapshot could not be read, ignoring...")
+        return None
+    finally:
+        con.close()
+    # Updates need the field fingerprints of each record
+    fcols = field_columns(state)
+    if settings.update and len(fcols) != len(cols):
+        print("     Snapshot has no field fingerprints, ignoring...")
+        return None
+    if not settings.update:
+        state = state.drop(columns = fcols)
+    for col in field_columns(state):
+        state[col] = state[col].astype('uint32')
+    settings.watermark = meta.get('watermark', '')
+    # Fingerprints are stored as signed 64 bit integers
+    state['fp'] = state['fp'].to_numpy(dtype = 'int64').view('uint64')
+    state['id'] = state['id'].astype(object)
+    state['uid'] = state['uid'].astype(str)
+    return state
+
+# Saves the IFB page state after a successful sync
+def save_snapshot(state, settings, cols):
+    meta = {'page_id': str(settings.page_id), 'uid_col': settings.uid_col,
+            'columns': ','.join(cols), 'watermark': settings.watermark}
+    fcols = field_columns(state)
+    rows = zip(state['id'].tolist(), state['uid'].tolist(),
+               np.asarray(state['fp'], dtype = 'uint64').view('int64').tolist(),
+               *[state[col].tolist() for col in fcols])
+    con = sqlite3.connect(snapshot_path(settings))
+    try:
+        with con:
+            con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # The field fingerprint columns vary with the compared columns
+            con.execute("DROP TABLE IF EXISTS records")
+            con.execute("CREATE TABLE records (id INTEGER PRIMARY KEY, uid TEXT, fp INTEGER%s)" %
+                        ''.join([', %s INTEGER' % col for col in fcols]))
+            con.execute("DELETE FROM meta")
+            con.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+            con.executemany("INSERT INTO records VALUES (%s)" % ', '.join(['?'] * (3 + len(fcols))), rows)
+    finally:
+        con.close()
+
+# Reads the manifest of the last successful sync from the snapshot file: the
+# snapshot metadata plus hashes of the source and INI files, or {} if none
+def load_manifest(settings):
+    path = snapshot_path(settings)
+    if not os.path.exists(path):
+        return {}
+    con = sqlite3.connect(path)
+    try:
+        return dict(con.execute("SELECT key, value FROM meta").fetchall())
+    except sqlite3.Error:
+        return {}
+    finally:
+        con.close()
+
+# Records the source and INI file hashes of a successful sync
+def save_manifest(settings):
+    con = sqlite3.connect(snapshot_path(settings))
+    try:
+        with con:
+            con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            con.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                            [('source_hash', settings.source_hash),
+                             ('settings_hash', settings.settings_hash)])
+    finally:
+        con.close()
+
+# Removes the snapshot so the next sync does a full refresh
+def drop_snapshot(settings):
+    if os.path.exists(snapshot_path(settings)):
+        os.remove(snapshot_path(settings))
+
+# Number of records read per API call when paging through a page's records
+read_limit = 1000
+
+# Class reading the records of the page matching grammar in a background
+# thread, one API call of read_limit records at a time, from when it is
+# created; iterating over it yields the lists of records read. At most ahead
+# lists wait to be consumed, so only a few pages of records are held in memory
+class remote_pages():
+    def __init__(self, api, settings, grammar, ahead = 2):
+        self.api = api
+        self.settings = settings
+        self.grammar = grammar
+        self.pages = queue.Queue(maxsize = ahead)
+        self.stop = threading.Event()
+        threading.Thread(target = self.fetch, daemon = True).start()
+
+    # Puts an item on the queue unless reading was stopped
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.pages.put(item, timeout = 0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(self):
+        offset = 0
+        try:
             while True:
-                if end > nrow - 1:
-                    end = nrow - 1
-                print("     Uploading rows %s to %s..." % (start + 1, end + 1))
-                api.createRecords(settings.profile_id, settings.page_id,
-                                    body = df_to_ifb(df[start:end + 1]))
-                if end == nrow - 1:
+                batch = self.api.readRecords(self.settings.profile_id, self.settings.page_id,
+                                             grammar = self.grammar, offset = offset, limit = read_limit)
+                if not self.put(batch) or len(batch) < read_limit:
                     break
-                start += 1000
-                end += 1000
+                offset += read_limit
+            self.put(None)
+        except Exception as e:
+            self.put(e)
 
+    def __iter__(self):
+        try:
+            while True:
+                batch = self.pages.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            self.close()
 
-def main():
-    # Counter for total API calls used
+    # Stops reading, for records that are no longer needed
+    def close(self):
+        self.stop.set()
+
+# Builds the remote state of the records read from pages, fingerprinting each
+# list of records as it arrives while the next downloads; returns the state
+# and the latest modified_date of the records, or watermark if later
+def paged_state(pages, settings, element_list, cols, watermark = ''):
+    parts = list()
+    for batch in pages:
+        if len(batch) > 0:
+            parts.append(remote_state(ifb_to_df(batch, ['id'] + element_list), settings.uid_col, cols,
+                                      settings.update))
+            watermark = max_modified(batch, watermark)
+    if len(parts) == 0:
+        return remote_state(ifb_to_df([], ['id'] + element_list), settings.uid_col, cols,
+                            settings.update), watermark
+    return pd.concat(parts, ignore_index = True), watermark
+
+# Number of records on the page, from the Total-Count header of a one record
+# read, or None if the API does not send it
+def record_count(api, settings):
+    metrics_local.headers = None
+    api.readRecords(settings.profile_id, settings.page_id, grammar = 'id', offset = 0, limit = 1)
+    try:
+        return int(metrics_local.headers['Total-Count'])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+# Brings a snapshot up to date with records modified in IFB since it was
+# taken; returns None if IFB holds records the snapshot cannot account for,
+# or the snapshot has no watermark to read modified records from
+def refresh_snapshot(state, api, settings, element_list, cols):
+    if not settings.watermark:
+        print("     Snapshot has no modified date to start from, doing a full refresh...")
+        return None
+    flds = ','.join([str(element) for element in element_list])
+    # The watermark is the newest modified date seen when the snapshot was
+    # read, so records modified in the same second are read again, as are
+    # the records written by the last sync, which compare as unchanged
+    grammar = 'id,modified_date(>="%s"),%s' % (settings.watermark, flds)
+    mod_state, watermark = paged_state(remote_pages(api, settings, grammar), settings, element_list, cols,
+                                       settings.watermark)
+    known = set(state['id'].tolist()) | set(mod_state['id'].tolist())
+    # Counted after the modified records are read, so records deleted or
+    # created since then change the count. Record ids are only listed, to
+    # find the records deleted or missed since the last sync, if the count
+    # does not match
+    count = record_count(api, settings)
+    if count is not None and count == len(known):
+        remote_ids = known
+    else:
+        if count is not None:
+            print("     %s records in IFB and %s in the snapshot, listing record ids..." % (count, len(known)))
+        remote_ids = set()
+        for batch in remote_pages(api, settings, 'id'):
+            remote_ids.update([record['id'] for record in batch])
+        unknown = remote_ids - known
+        if len(unknown) > 0:
+            print("     %s records in IFB are not in the snapshot, doing a full refresh..." % len(unknown))
+            return None
+    print("     %s records modified since last sync." % len(mod_state.index))
+    state = pd.concat([state[~state['id'].isin(mod_state['id'])], mod_state], ignore_index = True)
+    settings.watermark = watermark
+    return state[state['id'].isin(remote_ids)]
+
+# Applies a completed changeset to the remote state; returns None if the ids
+# of appended records could not be read from the upload results
+def synced_state(state, changes, append_results, settings):
+    # Row and field fingerprints
+    fp_cols = ['fp'] + field_columns(state)
+    state = state[~state['id'].isin(changes.delete)].copy()
+    if settings.update and len(changes.update) > 0:
+        fps = changes.source[fp_cols].iloc[changes.update].set_axis(pd.Index(changes.update_ids))
+        updated = state['id'].isin(fps.index)
+        for col in fp_cols:
+            state.loc[updated, col] = fps[col][state.loc[updated, 'id']].values
+    ids = list()
+    try:
+        for res in append_results:
+            ids.extend([record['id'] for record in res.result])
+    except (TypeError, KeyError):
+        return None
+    if len(ids) != len(changes.append):
+        return None
+    appended = pd.DataFrame(dict([('id', pd.Series(ids, dtype = object)),
+                                  ('uid', changes.source['uid'].to_numpy()[changes.append])] +
+                                 [(col, changes.source[col].to_numpy()[changes.append]) for col in fp_cols]))
+    return pd.concat([state, appended], ignore_index = True)
+
+# Path of the checkpoint journal of the current sync, stored next to the INI file
+def journal_path(settings):
+    return os.path.join(settings.cur_dir, file_stem(settings) + '_journal.jsonl')
+
+# Plain list of an array or list of ids or positions, for JSON
+def as_list(values):
+    return values.tolist() if hasattr(values, 'tolist') else list(values)
+
+# Class recording the work of a sync as it completes, one JSON object per
+# line: a start line describing the run, a line per finished step, and a line
+# per uploaded or deleted chunk with the record ids it returned. A failed sync
+# can then be resumed with --resume without redoing finished work
+class journal():
+    def __init__(self, settings):
+        self.path = journal_path(settings)
+        self.lock = threading.Lock()
+        self.header = None
+        self.steps = set()
+        # Record ids of each completed chunk, by action and first row
+        self.chunks = dict()
+
+    # Starts a new journal for a run described by header
+    def start(self, header):
+        self.header = header
+        self.steps = set()
+        self.chunks = dict()
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(dict(header, type = 'start')) + '\n')
+
+    # Reads the journal of an earlier run; returns False if there is none
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    break
+                if entry['type'] == 'start':
+                    self.header = entry
+                elif entry['type'] == 'step':
+                    self.steps.add(entry['name'])
+                elif entry['type'] == 'chunk':
+                    self.chunks[(entry['action'], entry['start'])] = entry['ids']
+        return self.header is not None
+
+    def write(self, entry):
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    # Records a finished step of the run
+    def step(self, name):
+        self.steps.add(name)
+        self.write({'type': 'step', 'name': name})
+
+    # Records a completed chunk
+    def chunk(self, action, start, ids):
+        with self.lock:
+            self.chunks[(action, start)] = ids
+        self.write({'type': 'chunk', 'action': action, 'start': start, 'ids': ids})
+
+    # Record ids of a completed chunk, or None if it was not completed
+    def done(self, action, start):
+        with self.lock:
+            return self.chunks.get((action, start))
+
+    # Removes the journal once the sync is complete
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Class holding the outcome of uploading one chunk of records
+class chunk_result():
+    def __init__(self, index, start, rows):
+        self.index = index
+        # Position of the first row of the chunk and number of rows
+        self.start = start
+        self.rows = rows
+        self.ok = False
+        self.error = None
+        # Value returned by the API call
+        self.result = None
+        # True if the chunk was sent by an earlier run and skipped
+        self.resumed = False
+
+# Sends one chunk, recording success or the error on its result and the
+# completed chunk in the journal
+def send_chunk(send, body, res, action, jrnl):
+    try:
+        res.result = send(body)
+        res.ok = True
+    except Exception as e:
+        res.error = str(e)
+    if res.ok and jrnl is not None:
+        ids = [record['id'] for record in res.result] if isinstance(res.result, list) else []
+        jrnl.chunk(action, res.start, ids)
+    status = 'done' if res.ok else 'FAILED: %s' % res.error
+    with print_lock:
+        print("     Rows %s to %s %s" % (res.start + 1, res.start + res.rows, status))
+
+# Sends chunks of bodies through a pool of settings.workers threads, keeping at
+# most that many requests in flight; returns the chunk results in order, with
+# row positions counted from start. Chunks the journal records as sent for
+# action are skipped, with the record ids the journal holds
+def upload_chunks(bodies, send, settings, start = 0, action = 'append'):
+    results = list()
+    pending = set()
+    jrnl = settings.journal
+    with ThreadPoolExecutor(max_workers = settings.workers) as pool:
+        for index, body in enumerate(bodies):
+            res = chunk_result(index, start, len(body))
+            results.append(res)
+            ids = jrnl.done(action, start) if jrnl is not None else None
+            if ids is not None:
+                res.ok, res.resumed = True, True
+                res.result = [{'id': rid} for rid in ids]
+            else:
+                pending.add(pool.submit(send_chunk, send, body, res, action, jrnl))
+            start += len(body)
+            # Wait for a free worker before building the next chunk
+            if len(pending) >= settings.workers:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+        wait(pending)
+    return results
+
+# Prints a summary of chunk results, returning the number of failed chunks
+def upload_summary(results, action):
+    failed = [res for res in results if not res.ok]
+    rows = sum([res.rows for res in results if res.ok])
+    print("     %s %s records in %s of %s chunks." %
+            (action, rows, len(results) - len(failed), len(results)))
+    resumed = len([res for res in results if res.resumed])
+    if resumed > 0:
+        print("     %s chunks were already sent before resuming." % resumed)
+    for res in failed:
+        print("     ERROR: rows %s to %s failed: %s" % (res.start + 1, res.start + res.rows, res.error))
+    return len(failed)
+
+# Send a dataframe of records to IFB in chunks of settings.chunk_size
+def send_records(df, api, settings, start = 0):
+    send = lambda body: api.createRecords(settings.profile_id, settings.page_id, body = body)
+    return upload_chunks(iter_record_bodies(df, settings.chunk_size), send, settings, start)
+
+# Send a dataframe of updated records with an id column to IFB in chunks
+def send_updates(df, api, settings, start = 0):
+    if 'id' not in df.columns:
+        sys.exit("ERROR: id column is missing from update data.")
+    send = lambda body: api.updateAllRecords(settings.profile_id, settings.page_id, body = body)
+    return upload_chunks(iter_record_bodies(df, settings.chunk_size, with_id = True), send, settings,
+                         start, 'update')
+
+# Send lists of row values to IFB in chunks of settings.chunk_size, as new
+# records, or as updates of the records in ids
+def send_rows(dcns, rows, api, settings, ids = None, start = 0):
+    if ids is None:
+        send = lambda body: api.createRecords(settings.profile_id, settings.page_id, body = body)
+    else:
+        send = lambda body: api.updateAllRecords(settings.profile_id, settings.page_id, body = body)
+    return upload_chunks(iter_row_bodies(dcns, rows, settings.chunk_size, ids), send, settings,
+                         start, 'append' if ids is None else 'update')
+
+# Send a dataframe of updated records with an id column to IFB holding only
+# the fields of cols that changed, one batch of calls per set of changed
+# fields; the bytes of unchanged fields left out are recorded on the metrics
+def send_field_updates(df, masks, cols, api, settings, start = 0):
+    results = list()
+    for mask, group in field_groups(masks, len(cols), len(df.index)):
+        flds = mask_fields(mask, cols)
+        sub = df.iloc[group]
+        api.metrics.record_saved(sum([field_bytes(dcn, sub[dcn].tolist()) for dcn in df.columns
+                                      if dcn != 'id' and dcn not in flds]))
+        results += send_updates(sub[flds + ['id']], api, settings, start + sum([res.rows for res in results]))
+    return results
+
+# Send the rows of the changeset to update as send_field_updates does, from
+# lists of row values
+def send_row_updates(dcns, rows, changes, cols, api, settings):
+    results = list()
+    for mask, group in field_groups(changes.update_fields, len(cols), len(changes.update)):
+        flds = mask_fields(mask, cols)
+        upd_rows = [rows[changes.update[pos]] for pos in group]
+        api.metrics.record_saved(sum([field_bytes(dcn, [row[i] for row in upd_rows])
+                                      for i, dcn in enumerate(dcns) if dcn not in flds]))
+        col_pos = [dcns.index(fld) for fld in flds]
+        results += send_rows(flds, [[row[i] for i in col_pos] for row in upd_rows], api, settings,
+                             [changes.update_ids[pos] for pos in group], sum([res.rows for res in results]))
+    return results
+
+# Deletes records from IFB by record id, one filtered delete call per chunk;
+# chunks the journal records as deleted are skipped
+def delete_records(del_ids, api, settings):
     calls = 0
+    nrow = len(del_ids)
+    size = settings.delete_chunk_size
+    for start in range(0, nrow, size):
+        chunk = del_ids[start:start + size]
+        if settings.journal is not None and settings.journal.done('delete', start) is not None:
+            continue
+        # Field grammar matching any of the record ids in the chunk
+        grammar = 'id(%s)' % '|'.join(['="%s"' % del_id for del_id in chunk])
+        api.deleteRecords(settings.profile_id, settings.page_id,
+                            grammar = grammar, limit = len(chunk))
+        calls += 1
+        if settings.journal is not None:
+            settings.journal.chunk('delete', start, [])
+        print("     Deleted records %s to %s of %s (%s API calls)..." %
+                (start + 1, start + len(chunk), nrow, calls))
+    return calls
+
+
+# Syncs the CSV of one INI file with its page, returning the number of API
+# requests made. An already connected api and the profile's page list may be
+# passed in to share them between syncs; new pages are added to the list. If
+# resume, work recorded in the journal of a failed sync of the same source
+# and settings is not repeated. A dict passed as state_cache keeps the page
+# state in memory between syncs of the same INI file, in place of a snapshot.
+# With [Targets], the CSV is loaded once and synced to every target at once,
+# and with shards, split across several pages of each target
+def sync(cur_dir, config_fn, full_sync = False, api = None, page_list_dict = None, resume = False,
+         state_cache = None):
     # Parse INI file
     print("Parsing INI...")
-    global s
-    s = settings()
-    # Get token for IFB API
+    s = settings(cur_dir, config_fn)
+    s.source_hash = file_hash(os.path.join(s.cur_dir, s.csv_in))
+    s.settings_hash = file_hash(os.path.join(s.cur_dir, s.config_fn))
+    src = source_data(s, state_cache is not None)
+    if len(s.targets) == 1:
+        return sync_destination(s, src, full_sync, api, page_list_dict, resume, state_cache)
+    print("Syncing %s to %s targets..." % (s.csv_in, len(s.targets)))
+    # The api and page list passed in are for the [API] destination only
+    with ThreadPoolExecutor(max_workers = len(s.targets)) as pool:
+        list(pool.map(lambda t: run_target(target_settings(s, t), t, src, full_sync,
+                                           api if t.name == '' else None,
+                                           page_list_dict if t.name == '' else None, resume, state_cache),
+                      s.targets))
+    target_summary(s.targets)
+    calls = sum([t.calls or 0 for t in s.targets])
+    failed = len([t for t in s.targets if t.status == 'failed'])
+    if failed > 0:
+        sys.exit("ERROR: %s of %s targets failed to sync. Syncing used %s API calls." %
+                    (failed, len(s.targets), calls))
+    print("Syncing to all targets complete. Syncing used %s API calls." % calls)
+    return calls
+
+# Syncs target t, or a shard, with its settings ts from the source loaded in
+# src, recording its outcome on t
+def run_target(ts, t, src, full_sync, api, page_list_dict, resume, state_cache):
+    start = time.time()
+    try:
+        t.calls = sync_destination(ts, src, full_sync, api, page_list_dict, resume, state_cache)
+        t.status = 'ok'
+    except SystemExit as e:
+        t.status = 'failed'
+        t.error = str(e)
+    except Exception as e:
+        t.status = 'failed'
+        t.error = '%s: %s' % (type(e).__name__, e)
+    t.seconds = time.time() - start
+    return t
+
+# Class holding the source data of a sync, shared by all of its targets. The
+# column names are read when first needed; the data of each set of columns
+# is read when first needed, once, and its rows fingerprinted once
+class source_data():
+    def __init__(self, settings, cached):
+        self.settings = settings
+        # Whether the page state is cached in memory, which needs pandas
+        self.cached = cached
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.reader = None
+        # Column names as read from the input file, by cleaned column name
+        self.raw = dict()
+        # Source data and states read, by columns
+        self.frames = dict()
+        self.states = dict()
+        # Data column name list, and the rows of a small CSV
+        self.dcns = None
+        self.rows = None
+
+    # Reads the column names on first use, and the rows of a small CSV
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                self.read()
+                self.loaded = True
+        return self
+
+    def read(self):
+        s = self.settings
+        # Load small CSV files as plain rows without pandas; the snapshot, the
+        # cached page state, chunked reads, shards and inferred types need
+        # pandas
+        loaded = None
+        if (s.source_format == 'csv' and s.fast_path_rows > 0 and s.memory_mb == 0 and not s.snapshot
+                and not self.cached and s.shards == 1 and not s.infer_types):
+            loaded = load_csv_rows(s.csv_in, s, s.fast_path_rows)
+        if loaded is not None:
+            self.dcns, self.rows = loaded
+            print("Loading CSV file %s (%s rows, fast path)" % (s.csv_in, len(self.rows)))
+            return
+        load_pandas()
+        self.reader = source_readers[s.source_format](s)
+        raw = self.reader.columns()
+        self.dcns = list(clean_columns(raw))
+        # Check for reserved column names
+        reserved_dcn_check(self.dcns)
+        self.raw = dict(zip(self.dcns, raw))
+        # Read the file in chunks if a memory ceiling is set
+        if s.memory_mb > 0:
+            s.csv_chunk_rows = chunk_rows(self.reader, raw, s)
+            print("Reading %s file %s in chunks of %s rows" % (s.source_format, s.csv_in, s.csv_chunk_rows))
+
+    # Function returning an iterator of normalized chunks of the columns cols
+    # of the source data; only those columns are read from the file
+    def chunks(self, cols):
+        s = self.settings
+        raw = [self.raw[col] for col in cols]
+        if s.memory_mb > 0:
+            return lambda: self.scan(cols)
+        return lambda: iter([self.frame(cols, raw)])
+
+    # Iterator of normalized chunks of the columns cols, read from the file
+    # without keeping them
+    def scan(self, cols):
+        s = self.settings
+        raw = [self.raw[col] for col in cols]
+        chunk_size = s.csv_chunk_rows if s.memory_mb > 0 else None
+        return (normalize_chunk(chunk, s) for chunk in self.reader.read(raw, chunk_size))
+
+    # The columns cols of the source data, loaded on first use
+    def frame(self, cols, raw):
+        s = self.settings
+        key = tuple(cols)
+        with self.lock:
+            if key not in self.frames:
+                print("Loading %s file %s (%s of %s columns)" % (s.source_format, s.csv_in, len(cols), len(self.dcns)))
+                self.frames[key] = normalize_chunk(next(iter(self.reader.read(raw))), s)
+            return self.frames[key]
+
+    # Source state of the compared columns cols, with field fingerprints if fields
+    def state(self, cols, fields):
+        key = (tuple(cols), fields)
+        with self.lock:
+            if key not in self.states:
+                self.states[key] = source_state(self.chunks(cols)(), self.settings.uid_col, cols, fields)
+            return self.states[key]
+
+# Syncs the page of the target of settings s, or its shard pages
+def sync_destination(s, src, full_sync = False, api = None, page_list_dict = None, resume = False,
+                     state_cache = None):
+    if s.shards > 1:
+        return sync_shards(s, src, full_sync, api, page_list_dict, resume, state_cache)
+    return sync_target(s, src, full_sync, api, page_list_dict, resume, state_cache)
+
+## Shards
+# With shards, the rows of the source are split by the shard column across
+# pages named form_name_1, form_name_2, ..., each synced as its own page.
+# The shard index kept next to the INI file holds the range boundaries and a
+# hash of the rows of each shard as of the last successful sync
+
+# Path of the shard index of the target of settings
+def shard_index_path(settings):
+    return os.path.join(settings.cur_dir, file_stem(settings) + '_shards.json')
+
+# Reads the shard index, or {} if there is none
+def load_shard_index(settings):
+    try:
+        with open(shard_index_path(settings)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Writes the shard index, replacing the old one in one step
+def save_shard_index(settings, index):
+    path = shard_index_path(settings)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent = 1)
+    os.replace(path + '.tmp', path)
+
+# Shard of each value of the shard column: a stable hash of the value, or
+# the range of the index boundaries it falls in, compared as numbers if the
+# boundaries were numbers
+def shard_numbers(values, settings, index):
+    if settings.shard_by == 'hash':
+        hashes = pd.util.hash_pandas_object(values.astype(str), index = False).to_numpy()
+        return (hashes % np.uint64(settings.shards)).astype(int)
+    if index['numeric']:
+        keys = pd.to_numeric(values, errors = 'coerce').to_numpy(dtype = float)
+        bounds = np.array(index['boundaries'], dtype = float)
+    else:
+        keys = values.astype(str).to_numpy(dtype = object)
+        bounds = np.array(index['boundaries'], dtype = object)
+    return np.searchsorted(bounds, keys, side = 'right')
+
+# Boundaries splitting the values of the shard column into shards of about
+# the same number of rows, and whether they are compared as numbers, which
+# they are if every value is a number
+def shard_boundaries(src, settings):
+    chunks = [chunk[settings.shard_col] for chunk in src.scan([settings.shard_col])]
+    values = pd.concat(chunks, ignore_index = True) if chunks else pd.Series([], dtype = object)
+    nums = pd.to_numeric(values, errors = 'coerce')
+    numeric = len(values) > 0 and not nums.isna().any()
+    keys = np.sort((nums if numeric else values).to_numpy())
+    if len(keys) == 0:
+        return numeric, []
+    bounds = [keys[len(keys) * (i + 1) // settings.shards] for i in range(settings.shards - 1)]
+    return bool(numeric), [float(b) if numeric else str(b) for b in bounds]
+
+# Reads every column of the source once, returning a hash of the rows of each
+# shard, the unique IDs of all rows, and the shard of each row, or None for
+# the latter if the source is read in chunks
+def shard_contents(src, settings, index):
+    n = settings.shards
+    totals = [0] * n
+    counts = [0] * n
+    uids = list()
+    numbers = list()
+    for chunk in src.scan(src.dcns):
+        nums = shard_numbers(chunk[settings.shard_col], settings, index)
+        fps = row_fingerprints(chunk, src.dcns)
+        for i in range(n):
+            mask = nums == i
+            # Sum of the row fingerprints, which does not depend on row order
+            totals[i] = (totals[i] + int(fps[mask].sum(dtype = 'uint64'))) % 2 ** 64
+            counts[i] += int(mask.sum())
+        uids.append(chunk[settings.uid_col])
+        numbers.append(nums)
+    hashes = ['%016x-%s' % (totals[i], counts[i]) for i in range(n)]
+    uids = pd.Index(pd.concat(uids, ignore_index = True) if uids else [])
+    if settings.memory_mb > 0:
+        return hashes, uids, None
+    return hashes, uids, np.concatenate(numbers) if numbers else np.array([], dtype = int)
+
+# Class holding the rows of one shard of the source data of a sync, read
+# through the source_data src holding all rows; numbers holds the shard of
+# each row if the source is read in one piece, else each chunk is split as read
+class shard_source():
+    def __init__(self, src, settings, index, shard, numbers):
+        self.src = src
+        self.settings = settings
+        self.index = index
+        self.shard = shard
+        self.numbers = numbers
+        self.lock = threading.Lock()
+        self.states = dict()
+        self.dcns = src.dcns
+        self.rows = None
+
+    def load(self):
+        return self
+
+    # Function returning an iterator of the rows of the shard in chunks of the
+    # columns cols of the source data
+    def chunks(self, cols):
+        s = self.settings
+        if self.numbers is not None:
+            frame = self.src.chunks(cols)
+            return lambda: (chunk[self.numbers == self.shard].reset_index(drop = True) for chunk in frame())
+        read = cols if s.shard_col in cols else cols + [s.shard_col]
+        chunks = self.src.chunks(read)
+        return lambda: (chunk[shard_numbers(chunk[s.shard_col], s, self.index) == self.shard][cols]
+                        .reset_index(drop = True) for chunk in chunks())
+
+    # Source state of the compared columns cols, with field fingerprints if fields
+    def state(self, cols, fields):
+        key = (tuple(cols), fields)
+        with self.lock:
+            if key not in self.states:
+                self.states[key] = source_state(self.chunks(cols)(), self.settings.uid_col, cols, fields)
+            return self.states[key]
+
+# Copy of the settings for syncing shard i of the target of settings to its
+# own page; its snapshot, journal and metrics files have the shard added
+def shard_settings(settings, i):
+    ss = copy.copy(settings)
+    name = 'shard%s' % (i + 1)
+    ss.target = settings.target + '_' + name if settings.target else name
+    ss.form_name = '%s_%s' % (settings.form_name, i + 1)
+    ss.form_label = '%s (%s of %s)' % (settings.form_label, i + 1, settings.shards)
+    ss.shards = 1
+    if settings.metrics_file:
+        root, ext = os.path.splitext(settings.metrics_file)
+        ss.metrics_file = '%s_%s%s' % (root, name, ext)
+    return ss
+
+# Splits the source loaded by src across the shard pages of the target of
+# settings s and syncs the shards whose rows changed since the last sync at
+# the same time, returning the number of API requests made. Rows moved to
+# another shard are deleted from their old page and appended to the new one
+def sync_shards(s, src, full_sync = False, api = None, page_list_dict = None, resume = False,
+                state_cache = None):
+    # Requests made to connect and list the pages, shared by the shards
+    m = metrics()
+    src.load()
+    if s.shard_col not in src.dcns:
+        sys.exit("ERROR: Shard column %s is missing from input data." % s.shard_col)
+    if s.uid_col not in src.dcns:
+        sys.exit("ERROR: Unique ID column %s is missing from input data." % s.uid_col)
+    # Start the index over if the sharding changed, and sync every shard if
+    # any other setting changed
+    index = load_shard_index(s)
+    layout = {'shards': s.shards, 'shard_col': s.shard_col, 'shard_by': s.shard_by}
+    if any([index.get(key) != value for key, value in layout.items()]) or index.get('boundaries') == []:
+        index = dict(layout, hashes = dict())
+        if s.shard_by == 'range':
+            index['numeric'], index['boundaries'] = shard_boundaries(src, s)
+    elif index.get('settings_hash') != s.settings_hash:
+        index['hashes'] = dict()
+    index['settings_hash'] = s.settings_hash
+    print("Splitting %s into %s shards by %s of %s..." % (s.csv_in, s.shards, s.shard_by, s.shard_col))
+    hashes, uids, numbers = shard_contents(src, s, index)
+    # A unique ID in two shards would be appended to both pages
+    if uids.duplicated().any():
+        sys.exit("ERROR: Unique ID column %s contains duplicate values." % s.uid_col)
+    shards = list()
+    for i in range(s.shards):
+        ss = shard_settings(s, i)
+        ss.shard_uids = uids
+        t = target(ss.form_name, s.server_name, s.profile_id, s.ifb_key, s.ifb_secret)
+        shards.append((ss, t, shard_source(src, s, index, i, numbers)))
+    due = [shard for i, shard in enumerate(shards) if full_sync or index['hashes'].get(str(i)) != hashes[i]]
+    print("     %s of %s shards changed since the last sync." % (len(due), s.shards))
+    if len(due) > 0:
+        m.phase('connect')
+        if api is None:
+            api = connect_api(s, m)
+        schedule_api(api, s.rate_limit, s.max_retries)
+        if page_list_dict is None:
+            page_list_dict = metered_api(api, m).readPages(profile_id = s.profile_id)
+        # The shards share the connection and its request scheduler
+        with ThreadPoolExecutor(max_workers = min(s.workers, len(due))) as pool:
+            list(pool.map(lambda shard: run_target(shard[0], shard[1], shard[2], full_sync, api, page_list_dict,
+                                                   resume, state_cache), due))
+    for i, (ss, t, shard) in enumerate(shards):
+        if t.status is None:
+            t.status = 'skipped'
+            t.calls = 0
+        elif t.status == 'ok':
+            index['hashes'][str(i)] = hashes[i]
+        else:
+            index['hashes'].pop(str(i), None)
+    save_shard_index(s, index)
+    target_summary([t for ss, t, shard in shards])
+    calls = m.requests + sum([t.calls or 0 for ss, t, shard in shards])
+    failed = len([t for ss, t, shard in shards if t.status == 'failed'])
+    if failed > 0:
+        sys.exit("ERROR: %s of %s shards failed to sync. Syncing used %s API calls." %
+                    (failed, s.shards, calls))
+    print("Syncing all shards complete. Syncing used %s API calls." % calls)
+    return calls
+
+# Connects to the IFB API of the target of settings s, recording the token
+# request in the metrics m
+def connect_api(s, m):
     print("Connecting to iFormBuilder API")
+    start = time.time()
     try:
         api = IFB(s.server_name + ".iformbuilder.com", s.ifb_key, s.ifb_secret)
     except:
         sys.exit(("ERROR: Could not connect to the IFB API. This is likely due to"
                     "invalid credentials or no internet connection."))
-    calls += 1
-    # Load CSV file
-    print("Loading CSV file %s" % (s.csv_in))
-    df = load_csv(s.csv_in)
-    # Data column name list
-    dcns = list(df.columns)
-    # Get list of all pages
-    page_list_dict = api.readPages(profile_id = s.profile_id)
-    calls += 1
-    page_list = [page['name'] for page in page_list_dict]
-    # If form name does not yet exist, create it
-    if s.form_name not in page_list:
-        # Create form
-        print("Creating new page %s." % (s.form_name))
-        s.page_id = api.createPage(profile_id = s.profile_id,
-            body = {'name': s.form_name, 'label': s.form_label})['id']
-        calls += 1
-        if s.page_id <= 0:
-            sys.exit("ERROR: Could not create new page %s" % (s.form_name))
-        # Add fields to page
-        body = [{'name': col, 'label': col, 'data_type': 1, 'data_size': s.field_length} for col in dcns]
-        api.createElements(s.profile_id, page_id, body)
-        calls += 1
+    # The token request is made before the session can be metered
+    m.record_call('token', time.time() - start)
+    m.record_request('token', time.time() - start, 0, 0, True)
+    return api
+
+# Syncs the CSV loaded by src with the page of the target of settings s,
+# returning the number of API requests made
+def sync_target(s, src, full_sync = False, api = None, page_list_dict = None, resume = False,
+                state_cache = None):
+    # API requests and phase timings of the run
+    m = metrics()
+    # Counter for chunks that failed to upload
+    failed = 0
+    # Pick up the journal of a failed sync if the source and settings are the same
+    s.journal = journal(s)
+    resumed = False
+    if resume:
+        if (s.journal.load() and s.journal.header['source_hash'] == s.source_hash
+                and s.journal.header['settings_hash'] == s.settings_hash):
+            print("Resuming failed sync from %s..." % os.path.basename(s.journal.path))
+            resumed = True
+        else:
+            print("No journal of a failed sync of this source and settings, starting a new sync...")
+            s.journal = journal(s)
+    # Skip the sync if neither the source nor the settings changed since the
+    # last successful sync
+    manifest = {}
+    if s.incremental and not resumed:
+        manifest = load_manifest(s)
+        if full_sync:
+            print("Full sync requested, ignoring changes since last sync...")
+        elif manifest.get('source_hash') == s.source_hash and manifest.get('settings_hash') == s.settings_hash:
+            print("Source data and settings unchanged since last sync, nothing to push.")
+            calls = finish_metrics(m, s)
+            print("Syncing complete. Syncing used %s API calls." % calls)
+            return calls
+    # The cached page state is only kept if this sync succeeds
+    cached = state_cache.pop(s.target, None) if state_cache is not None else None
+    # Get token for IFB API
+    m.phase('connect')
+    if api is None:
+        api = connect_api(s, m)
+    schedule_api(api, s.rate_limit, s.max_retries)
+    api = metered_api(api, m)
+    m.phase('load csv')
+    src.load()
+    dcns, rows = src.dcns, src.rows
+    # If only the source changed since the last sync, push the changed rows
+    # against the snapshot without listing the pages or fields of the profile
+    m.phase('fetch remote')
+    # Run description written to the journal, holding what is needed to resume
+    header = {'source_hash': s.source_hash, 'settings_hash': s.settings_hash}
+    delta = (s.snapshot and not full_sync and 'page_id' in manifest
+             and manifest.get('settings_hash') == s.settings_hash
+             and manifest.get('columns') == ','.join(dcns))
+    if resumed:
+        # The page and its fields were set up before the failure
+        s.page_id = s.journal.header['page_id']
+        element_list = s.journal.header['elements']
+    elif delta:
+        print("Source data changed since last sync, pushing changed rows only...")
+        s.page_id = int(manifest['page_id'])
+        element_list = list(dcns)
     else:
-        # Get page ID from page_list_dict
-        for page in page_list_dict:
-            if page['name'] == s.form_name:
-                s.page_id = page['id']
-                break
-        # If no uid_col, delete all records from the existing page
-        if s.has_uid == False:
-            print("No unique ID column provided, all records in form will be overwritten.")
-            api.deleteAllRecords(s.profile_id, s.page_id)
-            calls += 1
-    # List the fields in the form
-    element_dict = api.readElements(s.profile_id, s.page_id)
-    calls += 1
-    element_list = [element['name'] for element in element_dict]
-    # Check that all fields in input data are in destination form
-    missing_flds = [dcn for dcn in dcns if dcn not in element_list]
-    if len(missing_flds) > 0:
-        print(("WARNING: not all fields in input CSV have a match in the destination page."
-                "The following fields will not be loaded:"))
-        for fld in missing_flds:
-            print("     %s" % fld)
+        # Get list of all pages
+        if page_list_dict is None:
+            page_list_dict = api.readPages(profile_id = s.profile_id)
+        page_list = [page['name'] for page in page_list_dict]
+        # Whether the page may already hold records
+        header['clear'] = s.form_name in page_list
+        # If form name does not yet exist, create it
+        if s.form_name not in page_list:
+            # Create form
+            print("Creating new page %s." % (s.form_name))
+            s.page_id = api.createPage(profile_id = s.profile_id,
+                body = {'name': s.form_name, 'label': s.form_label})['id']
+            if s.page_id <= 0:
+                sys.exit("ERROR: Could not create new page %s" % (s.form_name))
+            page_list_dict.append({'id': s.page_id, 'name': s.form_name})
+            # Add fields to page
+            body = [{'name': col, 'label': col, 'data_type': 1, 'data_size': s.field_length} for col in dcns]
+            api.createElements(s.profile_id, s.page_id, body)
+        else:
+            # Get page ID from page_list_dict
+            for page in page_list_dict:
+                if page['name'] == s.form_name:
+                    s.page_id = page['id']
+                    break
+        # List the fields in the form
+        element_dict = api.readElements(s.profile_id, s.page_id)
+        element_list = [element['name'] for element in element_dict]
+        # Check that all fields in input data are in destination form
+        missing_flds = [dcn for dcn in dcns if dcn not in element_list]
+        if len(missing_flds) > 0:
+            print(("WARNING: not all fields in input CSV have a match in the destination page."
+                    "The following fields will not be loaded:"))
+            for fld in missing_flds:
+                print("     %s" % fld)
+    header.update({'page_id': s.page_id, 'elements': element_list})
+    # Read and send only the source columns present on the page
+    if rows is None:
+        chunks = src.chunks([dcn for dcn in dcns if dcn in element_list])
+    else:
+        page_pos = [i for i, dcn in enumerate(dcns) if dcn in element_list]
+        page_dcns = [dcns[i] for i in page_pos]
+        if len(page_pos) < len(dcns):
+            rows = [[row[i] for i in page_pos] for row in rows]
     # Now push all records to form
     print("Pushing records to form...")
     # If UID col is present in settings
@@ -283,57 +1712,179 @@ def main():
             sys.exit("ERROR: Unique ID column %s is missing from input data." % s.uid_col)
         if s.uid_col not in element_list:
             sys.exit("ERROR: Unique ID column %s is missing from source IFB page." % s.uid_col)
-        # Check that values in uid column are unique
-        source_uids = df[s.uid_col].tolist()
-        if len(source_uids) != len(set(source_uids)):
-            sys.exit("ERROR: Unique ID column %s contains duplicate values." % s.uid_col)
-        ## Get all records from API
-        # Collapse IFB elements to comma sep list for API call
-        flds = ','.join([str(element) for element in element_list])
-        # Get all records
-        ifb_records = api.readAllRecords(s.profile_id, s.page_id, grammar = 'id,' + flds)
-        calls += 1
-        # List of unique IDs in IFB
-        ifb_uids = [record[s.uid_col] for record in ifb_records]
-        # Append records in df not in IFB
-        append = df[~df[s.uid_col].isin(ifb_uids)]
-        if len(append.index) > 0:
-            print("     Appending %s new records..." % len(append.index))
-            send_records(df = append, api = api, settings = s)
-            calls += math.floor(len(append.index) / 1000)
-        # If update, find records in df different than in IFB and send update
-        if s.update:
-            # IFB records to pd
-            ifb_records_df = ifb_to_df(ifb_records)
-            # First find matches on all columns between df and ifb_records
-            same = pd.merge(df, ifb_records_df[dcns], on = dcns)
-            # The unique IDs that are not in the same df but are in the IFB and
-            # source data are the ones to update
-            same_uids = same[s.uid_col].tolist()
-            diff_uids = list(set(source_uids) - set(same_uids))
-            # Then filter source df by these unique ids
-            update = df[df[s.uid_col].isin(diff_uids)]
-            # Then inner join to IFB records to get record ID and remove records
-            # that are not in IFB
-            update_df = pd.merge(update, ifb_records_df[['id', s.uid_col]], on = s.uid_col)
-            if len(update_df.index) > 0:
-                print("     Updating %s records..." % len(update.index))
-                api.updateAllRecords(s.profile_id, s.page_id, body = df_to_ifb_u(update_df))
-                calls += math.floor(len(update_df.index) / 1000)
-        # If delete, get records in IFB not in df and delete
-        if s.delete:
-            del_ids = [ifb_records[i]['id'] for i in range(0, len(ifb_records)) if ifb_records[i][s.uid_col] not in df[s.uid_col].tolist()]
-            if len(del_ids) > 0:
-                print("     Deleting %s records..." % len(del_ids))
-                for del_id in del_ids:
-                    api.deleteRecord(s.profile_id, s.page_id, del_id)
-                    calls += 1
+        # Compare source and IFB on the columns present in both
+        cmp_cols = [dcn for dcn in dcns if dcn in element_list]
+        if resumed:
+            # Take the changes found before the failure from the journal
+            jh = s.journal.header
+            source = None
+            if rows is None:
+                m.phase('diff')
+                source = src.state(cmp_cols, s.update)
+                jh = dict(jh, append = np.array(jh['append'], dtype = int),
+                          update = np.array(jh['update'], dtype = int),
+                          update_ids = np.array(jh['update_ids'], dtype = object))
+            changes = changeset(source, jh['append'], jh['update'], jh['update_ids'],
+                                jh['delete'], jh['unchanged'], jh.get('update_fields'))
+        elif rows is not None:
+            # Check that values in uid column are unique
+            uids = set([row[page_dcns.index(s.uid_col)] for row in rows])
+            if len(uids) < len(rows):
+                sys.exit("ERROR: Unique ID column %s contains duplicate values." % s.uid_col)
+            # Get all records and compare them with the rows as text
+            flds = ','.join([str(element) for element in element_list])
+            ifb_records = api.readAllRecords(s.profile_id, s.page_id, grammar = 'id,' + flds)
+            m.phase('diff')
+            changes = diff_rows(page_dcns, rows, ifb_records, s.uid_col, cmp_cols)
+            del ifb_records
+        else:
+            # Collapse IFB elements to comma sep list for API call
+            flds = ','.join([str(element) for element in element_list])
+            # Page state cached by the last sync of the same page and columns
+            if cached is not None and cached['key'] != (s.page_id, s.uid_col, ','.join(cmp_cols), s.update):
+                cached = None
+            # Without a snapshot every record is needed; start reading them
+            # while the source rows are fingerprinted
+            pages = None
+            if (not s.snapshot and cached is None) or full_sync:
+                pages = remote_pages(api, s, 'id,modified_date,' + flds)
+            # Fingerprint source rows
+            m.phase('diff')
+            source = src.state(cmp_cols, s.update)
+            # Check that values in uid column are unique
+            if source['uid'].duplicated().any():
+                if pages is not None:
+                    pages.close()
+                sys.exit("ERROR: Unique ID column %s contains duplicate values." % s.uid_col)
+            ## Get IFB page state, from the snapshot if it can be brought up to date
+            m.phase('fetch remote')
+            state = None
+            if cached is not None and not full_sync:
+                state = cached['state']
+                s.watermark = cached['watermark']
+                print("     Fetching records modified since last sync...")
+                state = refresh_snapshot(state, api, s, element_list, cmp_cols)
+            elif s.snapshot and not full_sync:
+                state = load_snapshot(s, cmp_cols)
+                # Also when only the source changed, so records edited or
+                # deleted in IFB since the last sync are repaired
+                if state is not None:
+                    print("     Fetching records modified since last sync...")
+                    state = refresh_snapshot(state, api, s, element_list, cmp_cols)
+            if state is None:
+                # Get all records, fingerprinting them as they arrive
+                if pages is None:
+                    pages = remote_pages(api, s, 'id,modified_date,' + flds)
+                state, s.watermark = paged_state(pages, s, element_list, cmp_cols)
+            m.phase('diff')
+            changes = diff_state(source, state)
+        print("     %s new, %s changed, %s unchanged and %s stale records found." %
+                (len(changes.append), len(changes.update), changes.unchanged, len(changes.delete)))
+        if not s.update:
+            changes.update = changes.update[:0]
+            changes.update_ids = changes.update_ids[:0]
+            changes.update_fields = None
+        # Without delete, only the records of rows moved to another shard's
+        # page are removed
+        if not s.delete and not resumed:
+            moved = list()
+            if s.shard_uids is not None:
+                stale = state[state['id'].isin(changes.delete)]
+                moved = stale.loc[stale['uid'].isin(s.shard_uids), 'id'].tolist()
+                if len(moved) > 0:
+                    print("     %s records moved to another shard." % len(moved))
+            changes.delete = moved
+        if not resumed:
+            s.journal.start(dict(header, append = as_list(changes.append), update = as_list(changes.update),
+                                 update_ids = as_list(changes.update_ids), delete = as_list(changes.delete),
+                                 unchanged = int(changes.unchanged),
+                                 update_fields = None if changes.update_fields is None
+                                                 else as_list(changes.update_fields)))
+        # Append records in df not in IFB, and if update, send records in df
+        # different than in IFB, one chunk of source data at a time
+        append_results = list()
+        update_results = list()
+        if len(changes.append) > 0:
+            print("     Appending %s new records..." % len(changes.append))
+        if len(changes.update) > 0:
+            print("     Updating %s records..." % len(changes.update))
+        if rows is not None:
+            if len(changes.append) > 0:
+                m.phase('append')
+                append_results = send_rows(page_dcns, [rows[pos] for pos in changes.append], api, s)
+            if len(changes.update) > 0:
+                m.phase('update')
+                update_results = send_row_updates(page_dcns, rows, changes, cmp_cols, api, s)
+        elif len(changes.append) + len(changes.update) > 0:
+            for append, update, masks in changed_rows(chunks(), changes):
+                if len(append.index) > 0:
+                    m.phase('append')
+                    append_start = sum([res.rows for res in append_results])
+                    append_results += send_records(append, api, s, append_start)
+                if len(update.index) > 0:
+                    m.phase('update')
+                    update_start = sum([res.rows for res in update_results])
+                    update_results += send_field_updates(update, masks, cmp_cols, api, s, update_start)
+        if len(append_results) > 0:
+            failed += upload_summary(append_results, 'Appended')
+        if len(update_results) > 0:
+            failed += upload_summary(update_results, 'Updated')
+            print("     Sent changed fields only, leaving %.1f KB of unchanged fields out of updates." %
+                    (m.bytes_saved / 1024.0))
+        # If delete, remove records in IFB not in df
+        if len(changes.delete) > 0:
+            m.phase('delete')
+            print("     Deleting %s records in chunks of %s..." % (len(changes.delete), s.delete_chunk_size))
+            delete_records(changes.delete, api, s)
+        # Save the page state for the next sync, or force a full refresh; the
+        # state is not known after resuming
+        if s.snapshot or state_cache is not None:
+            m.phase('save snapshot')
+            state = synced_state(state, changes, append_results, s) if failed == 0 and not resumed else None
+            if state is None and s.snapshot:
+                drop_snapshot(s)
+                s.incremental = False
+            elif state is not None:
+                if s.snapshot:
+                    save_snapshot(state, s, cmp_cols)
+                if state_cache is not None:
+                    state_cache[s.target] = {'key': (s.page_id, s.uid_col, ','.join(cmp_cols), s.update),
+                                            'state': state, 'watermark': s.watermark}
     # Else push ALL records
     else:
-        send_records(df, api, s)
-        calls += math.floor(len(df.index) / 1000)
+        if not resumed:
+            s.journal.start(header)
+        # If no uid_col, delete all records from the existing page
+        if s.journal.header.get('clear') and 'delete_all' not in s.journal.steps:
+            print("No unique ID column provided, all records in form will be overwritten.")
+            m.phase('delete')
+            api.deleteAllRecords(s.profile_id, s.page_id)
+            s.journal.step('delete_all')
+        m.phase('append')
+        results = list()
+        if rows is not None:
+            results = send_rows(page_dcns, rows, api, s)
+        else:
+            for chunk in chunks():
+                results += send_records(chunk, api, s, sum([res.rows for res in results]))
+        failed += upload_summary(results, 'Appended')
+    # Record the source that was synced
+    if s.incremental and failed == 0:
+        save_manifest(s)
     # Complete
+    calls = finish_metrics(m, s)
+    if failed > 0:
+        print("     Completed chunks are recorded in %s; run again with --resume to send only the rest."
+                % os.path.basename(s.journal.path))
+        sys.exit("ERROR: Syncing finished with %s failed chunks. Syncing used %s API calls." % (failed, calls))
+    s.journal.remove()
     print("Syncing complete. Syncing used %s API calls." % calls)
+    return calls
+
+def main():
+    cur_dir, config_fn, full_sync, resume = parse_args()
+    print_banner()
+    sync(cur_dir, config_fn, full_sync, resume = resume)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,389 @@
+#-------------------------------------------------------------------------------
+# Name:        ifb_multi_syncer
+# Purpose:     Runs many form and option list syncs in one process, sharing one
+#              API connection and profile listing per server and profile.
+#
+# Author:      Bill DeVoe, Maine Department of Marine Resources
+#
+# Created:     09/22/2020
+# Copyright:   (c) Bill DeVoe 2020
+# License:     MIT
+#-------------------------------------------------------------------------------
+from ifb import IFB
+import configparser
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# watchdog is optional; it is notified of file changes by the operating
+# system (inotify on Linux), and without it watched files are polled
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# The form and option list syncers and their shared code live in sibling
+# directories
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for sub_dir in ['common', 'form_syncer', 'option_list_syncer']:
+    sys.path.insert(0, os.path.join(base_dir, sub_dir))
+
+import ifb_common
+import ifb_form_syncer
+import ifb_list_syncer
+
+def print_banner():
+    print()
+    print("-----------------------------------------------------------------------")
+    print("iFormBuilder Multi Job Syncer")
+    print("Created by Bill DeVoe, 2020. Distributed under MIT License")
+    print("For questions, see the included documentation.")
+    print("Contact: william.devoe@maine.gov or bdevoe@gmail.com")
+    print("-----------------------------------------------------------------------")
+    print()
+
+# Gets the value of a --name=value option from the command line as a number
+# of type cast, or default if not given
+def number_arg(name, default, cast, minimum):
+    value = default
+    for arg in sys.argv:
+        if arg.startswith('--%s=' % name):
+            try:
+                value = cast(arg.split('=', 1)[1])
+            except ValueError:
+                sys.exit("--%s must be a %s." % (name, 'whole number' if cast is int else 'number'))
+            if value < minimum:
+                sys.exit("--%s must be at least %s." % (name, minimum))
+    return value
+
+# Class holding the command line options
+class options():
+    def __init__(self):
+        self.full_sync = '--full' in sys.argv
+        self.resume = '--resume' in sys.argv
+        self.workers = number_arg('workers', 4, int, 1)
+        # Watch mode: seconds a changed file must be left unchanged before it
+        # is synced, and seconds between checks of the watched files
+        self.watch = '--watch' in sys.argv
+        self.debounce = number_arg('debounce', 2.0, float, 0)
+        self.poll = number_arg('poll', 1.0, float, 0.1)
+        self.status_file = None
+        for arg in sys.argv:
+            if arg.startswith('--status='):
+                self.status_file = arg.split('=', 1)[1]
+
+# Gets the job directory or manifest and the options from the command line
+def parse_args():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    try:
+        jobs_in = args[0]
+    except IndexError:
+        sys.exit(("A directory of INI files or a manifest file listing INI files "
+                  "was not provided. Please provide one as a command line argument."))
+    if not os.path.exists(jobs_in):
+        sys.exit("The job directory or manifest %s does not exist." % jobs_in)
+    return jobs_in, options()
+
+# Class holding one INI file to sync
+class job():
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.cur_dir = os.path.dirname(self.path)
+        self.config_fn = os.path.basename(self.path)
+        self.kind = None
+        self.server_name = None
+        self.profile_id = None
+        self.ifb_key = None
+        self.ifb_secret = None
+        # Request scheduling of the server, from the Performance section
+        self.rate_limit = 0
+        self.max_retries = 5
+        # ok, skipped or failed
+        self.status = 'skipped'
+        self.calls = 0
+        self.seconds = 0
+        self.error = ''
+        # Files whose changes trigger the job in watch mode
+        self.watched = [self.path]
+        # Runs and failed runs in watch mode, and when the job last finished
+        self.runs = 0
+        self.failures = 0
+        self.total_calls = 0
+        self.finished = None
+        # Page state kept in memory between form syncs in watch mode
+        self.state_cache = None
+
+    # Reads the job type and API credentials from the INI file
+    def inspect(self):
+        config = configparser.ConfigParser()
+        config.read(self.path)
+        if config.has_section('Form'):
+            self.kind = 'form'
+        elif config.has_section('List'):
+            self.kind = 'list'
+        else:
+            self.error = 'INI file has neither a Form nor a List section'
+            return
+        csv_in = config.get('Form' if self.kind == 'form' else 'List', 'csv_in', fallback = None)
+        if csv_in:
+            self.watched.append(os.path.join(self.cur_dir, csv_in))
+        try:
+            self.server_name = config.get('API', 'server_name')
+            self.profile_id = config.getint('API', 'profile_id')
+            self.ifb_key = config.get('API', 'ifb_key')
+            self.ifb_secret = config.get('API', 'ifb_secret')
+            self.rate_limit = config.getfloat('Performance', 'rate_limit', fallback = 0)
+            self.max_retries = config.getint('Performance', 'max_retries', fallback = 5)
+        except (configparser.Error, ValueError) as e:
+            self.kind = None
+            self.error = str(e)
+
+# Returns the INI files of a directory, or the INI paths listed one per line in
+# a manifest file; relative paths in a manifest are relative to the manifest
+def find_jobs(jobs_in):
+    if os.path.isdir(jobs_in):
+        paths = [os.path.join(jobs_in, fn) for fn in sorted(os.listdir(jobs_in))
+                 if fn.lower().endswith('.ini')]
+    else:
+        paths = []
+        with open(jobs_in) as f:
+            for line in f:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                paths.append(os.path.join(os.path.dirname(os.path.abspath(jobs_in)), line))
+    return [job(path) for path in paths]
+
+# Shares one authenticated API connection per set of credentials, and one
+# page or option list listing per server and profile, between jobs
+class session_cache():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.apis = {}
+        self.listings = {}
+        # Requests made for the shared connections and listings
+        self.metrics = ifb_common.metrics()
+
+    def api(self, j):
+        key = (j.server_name, j.ifb_key, j.ifb_secret)
+        with self.lock:
+            if key not in self.apis:
+                start = time.time()
+                try:
+                    self.apis[key] = IFB(j.server_name + ".iformbuilder.com", j.ifb_key, j.ifb_secret)
+                except:
+                    sys.exit(("ERROR: Could not connect to the IFB API. This is likely due to"
+                              "invalid credentials or no internet connection."))
+                self.metrics.record_call('token', time.time() - start)
+                self.metrics.record_request('token', time.time() - start, 0, 0, True)
+            # Jobs on the same connection share its request scheduler
+            ifb_common.schedule_api(self.apis[key], j.rate_limit, j.max_retries)
+            return self.apis[key]
+
+    def listing(self, j, api):
+        key = (j.server_name, j.profile_id, j.kind)
+        with self.lock:
+            if key not in self.listings:
+                metered = ifb_common.metered_api(api, self.metrics)
+                if j.kind == 'form':
+                    self.listings[key] = metered.readPages(profile_id = j.profile_id)
+                else:
+                    self.listings[key] = metered.readAllOptionLists(j.profile_id)
+            return self.listings[key]
+
+    # Drops the listing used by a failed job, so it is read again next time
+    def forget(self, j):
+        with self.lock:
+            self.listings.pop((j.server_name, j.profile_id, j.kind), None)
+
+# Runs a single job, recording its outcome on the job
+def run_job(j, cache, full_sync, resume):
+    start = time.time()
+    j.calls = 0
+    j.error = ''
+    try:
+        api = cache.api(j)
+        listing = cache.listing(j, api)
+        if j.kind == 'form':
+            j.calls = ifb_form_syncer.sync(j.cur_dir, j.config_fn, full_sync,
+                                           api = api, page_list_dict = listing, resume = resume,
+                                           state_cache = j.state_cache)
+        else:
+            j.calls = ifb_list_syncer.sync(j.cur_dir, j.config_fn, full_sync,
+                                           api = api, all_lists = listing)
+        j.status = 'ok'
+    except SystemExit as e:
+        j.status = 'failed'
+        j.error = str(e)
+    except Exception as e:
+        j.status = 'failed'
+        j.error = '%s: %s' % (type(e).__name__, e)
+    j.seconds = time.time() - start
+    j.runs += 1
+    j.total_calls += j.calls
+    j.finished = datetime.datetime.now().isoformat(timespec = 'seconds')
+    if j.status == 'failed':
+        j.failures += 1
+        cache.forget(j)
+    return j
+
+# Prints one line per job
+def job_summary(jobs, shared_calls):
+    width = max([len(j.config_fn) for j in jobs] + [3])
+    print("%s  Type  Status   Calls  Seconds  Error" % 'INI'.ljust(width))
+    for j in jobs:
+        print("%s  %s  %s  %5s  %7.1f  %s" % (j.config_fn.ljust(width), (j.kind or '-').ljust(4),
+              j.status.ljust(7), j.calls, j.seconds, j.error))
+    print("Shared connections and listings used %s API calls." % shared_calls)
+
+## Watch mode
+
+# Modification time and size of a file, or None while it does not exist
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+# Class watching a set of files for changes. With watchdog installed the
+# operating system wakes the watcher on changes; the files are also polled
+# every poll seconds, which is the only check without watchdog
+class file_watcher():
+    def __init__(self, paths, poll):
+        self.paths = sorted(set(paths))
+        self.poll = poll
+        self.woken = threading.Event()
+        self.signatures = dict([(path, file_signature(path)) for path in self.paths])
+        self.observer = None
+        if Observer is not None:
+            self.observer = Observer()
+            for folder in set([os.path.dirname(path) for path in self.paths]):
+                self.observer.schedule(self, folder, recursive = False)
+            self.observer.start()
+        self.kind = 'notify' if self.observer is not None else 'polling'
+
+    # Called by watchdog for each file system event in a watched folder
+    def dispatch(self, event):
+        self.woken.set()
+
+    # Waits for watched files to change; returns the changed files once none
+    # has changed for debounce seconds and all of them exist, so a file still
+    # being written is not synced part way
+    def changes(self, debounce):
+        pending = dict()
+        while True:
+            self.woken.wait(self.poll)
+            self.woken.clear()
+            now = time.time()
+            for path in self.paths:
+                sig = file_signature(path)
+                if sig != self.signatures[path]:
+                    self.signatures[path] = sig
+                    pending[path] = now
+            if (len(pending) > 0 and now - max(pending.values()) >= debounce
+                    and all([self.signatures[path] is not None for path in pending])):
+                return set(pending)
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+
+# Path of the watch mode status file; by default next to the manifest, or in
+# the job directory
+def status_path(jobs_in, status_file):
+    if status_file:
+        return os.path.abspath(status_file)
+    if os.path.isdir(jobs_in):
+        return os.path.join(os.path.abspath(jobs_in), 'ifb_multi_syncer_status.json')
+    return os.path.splitext(os.path.abspath(jobs_in))[0] + '_status.json'
+
+# Writes the health and metrics of the watcher and each job as JSON, replacing
+# the file in one step so readers never see it part written
+def write_status(path, state, started, watcher, jobs, cache):
+    status = {
+        'state': state,
+        'pid': os.getpid(),
+        'started': started,
+        'updated': datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'watcher': watcher.kind,
+        'watched_files': len(watcher.paths),
+        'shared_calls': cache.metrics.requests,
+        'total_calls': cache.metrics.requests + sum([j.total_calls for j in jobs]),
+        'jobs': [{'ini': j.path, 'type': j.kind, 'status': j.status, 'runs': j.runs, 'failures': j.failures,
+                  'last_finished': j.finished, 'last_calls': j.calls, 'last_seconds': round(j.seconds, 3),
+                  'total_calls': j.total_calls, 'error': j.error} for j in jobs],
+    }
+    with open(path + '.tmp', 'w') as f:
+        json.dump(status, f, indent = 2)
+    os.replace(path + '.tmp', path)
+
+# Runs jobs together in the pool
+def run_jobs(jobs, pool, cache, opts, resume):
+    list(pool.map(lambda j: run_job(j, cache, opts.full_sync, resume or j.status == 'failed'), jobs))
+
+# Syncs every job, then keeps running and syncs the jobs whose INI or CSV
+# files change, until stopped with Ctrl+C. The API connections, listings
+# and the page state of form jobs are kept between syncs
+def watch(jobs, runnable, cache, opts, path):
+    started = datetime.datetime.now().isoformat(timespec = 'seconds')
+    for j in runnable:
+        if j.kind == 'form':
+            j.state_cache = dict()
+    watcher = file_watcher([fn for j in runnable for fn in j.watched], opts.poll)
+    print("Watching %s files for changes (%s), status in %s" % (len(watcher.paths), watcher.kind, path))
+    pool = ThreadPoolExecutor(max_workers = opts.workers)
+    try:
+        write_status(path, 'syncing', started, watcher, jobs, cache)
+        run_jobs(runnable, pool, cache, opts, opts.resume)
+        job_summary(jobs, cache.metrics.requests)
+        # Only the first round ignores the snapshots and manifests
+        opts.full_sync = False
+        while True:
+            write_status(path, 'watching', started, watcher, jobs, cache)
+            changed = watcher.changes(opts.debounce)
+            due = [j for j in runnable if len(changed.intersection(j.watched)) > 0]
+            print("%s  %s changed files, syncing %s jobs..." %
+                    (datetime.datetime.now().strftime('%H:%M:%S'), len(changed), len(due)))
+            write_status(path, 'syncing', started, watcher, jobs, cache)
+            run_jobs(due, pool, cache, opts, False)
+            job_summary(due, cache.metrics.requests)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        watcher.stop()
+        pool.shutdown(wait = True)
+        write_status(path, 'stopped', started, watcher, jobs, cache)
+
+# Main program
+def main():
+    jobs_in, opts = parse_args()
+    print_banner()
+    jobs = find_jobs(jobs_in)
+    if len(jobs) == 0:
+        sys.exit("No INI files found in %s." % jobs_in)
+    for j in jobs:
+        j.inspect()
+    runnable = [j for j in jobs if j.kind is not None]
+    for j in jobs:
+        if j.kind is None:
+            j.status = 'failed'
+    print("Running %s jobs with %s workers..." % (len(runnable), opts.workers))
+    cache = session_cache()
+    if opts.watch:
+        watch(jobs, runnable, cache, opts, status_path(jobs_in, opts.status_file))
+        return
+    with ThreadPoolExecutor(max_workers = opts.workers) as pool:
+        list(pool.map(lambda j: run_job(j, cache, opts.full_sync, opts.resume), runnable))
+    job_summary(jobs, cache.metrics.requests)
+    total = cache.metrics.requests + sum([j.calls for j in jobs])
+    print("All jobs complete. Jobs used %s API calls." % total)
+    if any([j.status == 'failed' for j in jobs]):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
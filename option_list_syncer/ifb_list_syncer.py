@@ -10,44 +10,75 @@
 #-------------------------------------------------------------------------------
 from ifb import IFB
 import configparser
-import pandas as pd
+import sqlite3
+import json
+import time
+import bisect
 import os
 import sys
-import math
-
-print()
-print("-----------------------------------------------------------------------")
-print("iFormBuilder Option List Syncer")
-print("Created by Bill DeVoe, 2020. Distributed under MIT License")
-print("For questions, see the included documentation.")
-print("Contact: william.devoe@maine.gov or bdevoe@gmail.com")
-print("-----------------------------------------------------------------------")
-print()
-
-# Get current directory from command line
-try:
-    cur_dir = sys.argv[1]
-    #cur_dir = os.path.dirname(__file__)
-except:
-    sys.exit(("The program directory was either not provided or does not exist."
-    "Please provide program directory as command line argument."))
-
-if os.path.exists(cur_dir):
-    print("Running from directory: %s" % (os.path.basename(cur_dir)))
-else:
-    sys.exit(("The program directory was either not provided or does not exist."
-    "Please provide program directory as command line argument."))
-
-try:
-    config_fn = sys.argv[2]
-    #config_fn = 'settings.ini'
-except:
-    config_fn = "config.ini"
-    print("Config file name not provided, defaulting to config.ini...")
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Code shared with the form syncer lives in the common directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+from ifb_common import (target, target_settings, target_summary, file_stem, file_hash, metrics_local,
+                        metrics, metered_api, schedule_api, finish_metrics, print_lock)
+
+# pandas and numpy are imported by load_pandas() when first needed, so runs
+# with nothing to push do not pay their start-up
+pd = None
+np = None
+
+# Imports pandas and numpy into the module namespace
+def load_pandas():
+    global pd, np
+    if pd is None:
+        import pandas
+        import numpy
+        pd, np = pandas, numpy
+
+# Prints the program banner
+def print_banner():
+    print()
+    print("-----------------------------------------------------------------------")
+    print("iFormBuilder Option List Syncer")
+    print("Created by Bill DeVoe, 2020. Distributed under MIT License")
+    print("For questions, see the included documentation.")
+    print("Contact: william.devoe@maine.gov or bdevoe@gmail.com")
+    print("-----------------------------------------------------------------------")
+    print()
+
+# Gets the program directory, INI file name and --full flag from the command line
+def parse_args():
+    # Flags may be given anywhere after the program name
+    args = [arg for arg in sys.argv if not arg.startswith('--')]
+    full_sync = '--full' in sys.argv
+    try:
+        cur_dir = args[1]
+        #cur_dir = os.path.dirname(__file__)
+    except:
+        sys.exit(("The program directory was either not provided or does not exist."
+        "Please provide program directory as command line argument."))
+
+    if os.path.exists(cur_dir):
+        print("Running from directory: %s" % (os.path.basename(cur_dir)))
+    else:
+        sys.exit(("The program directory was either not provided or does not exist."
+        "Please provide program directory as command line argument."))
+
+    try:
+        config_fn = args[2]
+        #config_fn = 'settings.ini'
+    except:
+        config_fn = "config.ini"
+        print("Config file name not provided, defaulting to config.ini...")
+    return cur_dir, config_fn, full_sync
 
 # Class handler to parse INI file
 class settings():
-    def __init__(self):
+    def __init__(self, cur_dir, config_fn):
+        self.cur_dir = cur_dir
+        self.config_fn = config_fn
         configfile = os.path.join(cur_dir, config_fn)
         if os.path.exists(configfile) != True:
             sys.exit(("Configuration file could not be found. "
@@ -77,6 +108,21 @@ class settings():
             self.ifb_secret = config.get("API", "ifb_secret")
         except:
             sys.exit("INI file is missing ifb_secret option.")
+        # Destinations synced from the CSV: the [API] server and profile, and
+        # optional [Targets], one per line as
+        # name: server_name, profile_id[, ifb_key, ifb_secret]
+        self.target = ''
+        self.targets = [target('', self.server_name, self.profile_id, self.ifb_key, self.ifb_secret)]
+        if config.has_section("Targets"):
+            for name, value in config.items("Targets"):
+                parts = [part.strip() for part in value.split(',')]
+                if len(parts) == 2:
+                    parts += [self.ifb_key, self.ifb_secret]
+                try:
+                    self.targets.append(target(name, parts[0], int(parts[1]), parts[2], parts[3]))
+                except (IndexError, ValueError):
+                    sys.exit(("INI Targets option %s must be server_name, profile_id or "
+                              "server_name, profile_id, ifb_key, ifb_secret." % name))
         ## Parse List options
         # CSV file name
         try:
@@ -92,33 +138,152 @@ class settings():
         except:
             self.update = True
             print("INI file is missing valid update option, defaulting to True...")
+        # Optional flag to delete options not in the source data
+        try:
+            self.delete = config.getboolean("List", "delete")
+        except:
+            self.delete = False
+        # Optional number of options removed per bulk delete call; the option
+        # ids are sent in the URL, so at most 200 ids are sent per call
+        try:
+            self.delete_chunk_size = config.getint("List", "delete_chunk_size")
+        except:
+            self.delete_chunk_size = 100
+        if self.delete_chunk_size < 1 or self.delete_chunk_size > 200:
+            sys.exit("INI delete_chunk_size option must be between 1 and 200.")
+        # Optional spacing of the sort orders given to new and moved options;
+        # if set, only options whose order changed are given new sort orders
+        try:
+            self.sort_gap = config.getint("List", "sort_gap")
+        except:
+            self.sort_gap = 0
+        if self.sort_gap < 0:
+            sys.exit("INI sort_gap option must be 0 or greater.")
+        # Optional flag to read CSV number and True/False columns as typed
+        # values, as versions before reading every column as text did
+        try:
+            self.infer_types = config.getboolean("List", "infer_types")
+        except:
+            self.infer_types = False
+        # Optional flag to skip unchanged source files and only sync option
+        # lists with changed rows
+        try:
+            self.incremental = config.getboolean("List", "incremental")
+        except:
+            self.incremental = False
+        ## Optional Performance options
+        # Number of option lists synced concurrently
+        try:
+            self.workers = config.getint("Performance", "workers")
+        except:
+            self.workers = 1
+        if self.workers < 1:
+            sys.exit("INI workers option must be 1 or greater.")
+        # Number of options sent per create or update call
+        try:
+            self.chunk_size = config.getint("Performance", "chunk_size")
+        except:
+            self.chunk_size = 1000
+        if self.chunk_size < 1 or self.chunk_size > 1000:
+            sys.exit("INI chunk_size option must be between 1 and 1000.")
+        # Memory ceiling in MB for the source data; the CSV is read in chunks
+        # if set
+        try:
+            self.memory_mb = config.getint("Performance", "memory_mb")
+        except:
+            self.memory_mb = 0
+        if self.memory_mb < 0:
+            sys.exit("INI memory_mb option must be 0 or greater.")
+        # Requests per second allowed by the server, 0 for no limit
+        try:
+            self.rate_limit = config.getfloat("Performance", "rate_limit")
+        except:
+            self.rate_limit = 0
+        if self.rate_limit < 0:
+            sys.exit("INI rate_limit option must be 0 or greater.")
+        # Times a throttled or failed request is retried
+        try:
+            self.max_retries = config.getint("Performance", "max_retries")
+        except:
+            self.max_retries = 5
+        if self.max_retries < 0:
+            sys.exit("INI max_retries option must be 0 or greater.")
+        # Optional file the run metrics are written to, as .json or .csv
+        try:
+            self.metrics_file = config.get("Performance", "metrics_file")
+        except:
+            self.metrics_file = None
+        if self.metrics_file and os.path.splitext(self.metrics_file)[1].lower() not in ['.json', '.csv']:
+            sys.exit("INI metrics_file option must name a .json or .csv file.")
+        # Optional flag to print a summary of the run metrics
+        try:
+            self.metrics_summary = config.getboolean("Performance", "metrics_summary")
+        except:
+            self.metrics_summary = False
 
 # Loads CSV to Pandas dataframe
-def load_csv(csv_in):
-    # Read CSV
-    df = pd.read_csv(os.path.join(cur_dir, csv_in), na_filter = False)
-    # All columns to string
-    df = df.astype(str)
+def load_csv(csv_in, settings):
+    path = os.path.join(settings.cur_dir, csv_in)
     # Check that column names are correct
     req_cols = ['name', 'key_value', 'label', 'sort_order', 'condition_value']
-    missing = [col for col in req_cols if col not in df.columns]
+    missing = [col for col in req_cols if col not in pd.read_csv(path, nrows = 0).columns]
     if (len(missing) > 0):
         sys.exit("ERROR: Input CSV is missing one or more required columns:")
         for m in missing:
             print("     %s" % m)
-    # Format option list names and key values
-    df['name'] = df['name'].str.strip().str.lower().str.replace(' ', '_').str.extract('(\w+)', expand = False)
-    df['key_value'] = df['key_value'].str.strip().str.replace(' ', '_').str.extract('(\w+)', expand = False)
-    return df
+    # Read CSV, the required columns only and all as text, in chunks sized to
+    # settings.memory_mb if set
+    chunk_rows = csv_chunk_rows(path, req_cols, settings)
+    if settings.infer_types:
+        # Number and True/False columns as the text of the values pandas
+        # infers, as versions before reading every column as text did
+        reader = pd.read_csv(path, na_filter = False, usecols = req_cols, chunksize = chunk_rows)
+        reader = reader.astype(str) if chunk_rows is None else (df.astype(str) for df in reader)
+    else:
+        reader = pd.read_csv(path, dtype = str, na_filter = False, usecols = req_cols, chunksize = chunk_rows)
+    chunks = list()
+    for df in ([reader] if settings.memory_mb == 0 else reader):
+        # Format option list names and key values
+        df['name'] = df['name'].str.strip().str.lower().str.replace(' ', '_').str.extract('(\w+)', expand = False)
+        df['key_value'] = df['key_value'].str.strip().str.replace(' ', '_').str.extract('(\w+)', expand = False)
+        chunks.append(df)
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.concat(chunks, ignore_index = True)
+
+# Number of CSV rows per chunk that keeps a chunk of the columns cols within
+# a quarter of the settings.memory_mb ceiling, estimated from a sample of
+# rows, or None to read the CSV in one piece if memory_mb is not set
+def csv_chunk_rows(path, cols, settings):
+    if settings.memory_mb == 0:
+        return None
+    sample = pd.read_csv(path, dtype = str, na_filter = False, usecols = cols, nrows = 1000)
+    if len(sample.index) == 0:
+        return 1000
+    row_bytes = sample.memory_usage(index = False, deep = True).sum() / len(sample.index)
+    return max(int(settings.memory_mb * 1024 * 1024 / 4 / max(row_bytes, 1)), 100)
 
-# Sends new options to IFB
+# Option attributes compared with IFB and sent in updates
+update_flds = ['label', 'sort_order', 'condition_value']
+
+# Builds IFB option bodies straight from the dataframe column arrays, yielding
+# lists of at most chunk_size options; with_id includes the option id, and
+# flds limits the bodies to the given attributes
+def iter_option_bodies(options, chunk_size = 1000, with_id = False, flds = None):
+    if flds is None:
+        flds = ['key_value', 'label', 'sort_order', 'condition_value']
+    if with_id:
+        flds = ['id'] + flds
+    arrays = [options[fld].to_numpy() for fld in flds]
+    nrow = len(options.index)
+    for start in range(0, nrow, chunk_size):
+        rows = zip(*[arr[start:start + chunk_size].tolist() for arr in arrays])
+        yield [dict(zip(flds, row)) for row in rows]
+
+# Sends new options to IFB in chunks of settings.chunk_size
 def send_options(options, option_list_id, api, settings):
-    # Organize options df into list of dicts
-    body = list()
-    for index, row in options.iterrows():
-        body.append({'key_value': row['key_value'], 'label': row['label'],
-                        'sort_order': row['sort_order'], 'condition_value': row['condition_value']})
-    api.createOptions(settings.profile_id, option_list_id, body)
+    for body in iter_option_bodies(options, settings.chunk_size):
+        api.createOptions(settings.profile_id, option_list_id, body)
 
 # Retrieves options from option list as pandas df
 def retrieve_options(option_list_id, api, settings):
@@ -138,95 +303,473 @@ def retrieve_options(option_list_id, api, settings):
     df = df.fillna('')
     return df
 
-# Updates options from input options as pandas df
-def send_update(options, option_list_id, api, settings):
-    # Organize options df into list of dicts
-    body = list()
-    for index, row in options.iterrows():
-        body.append({'id': row['id'], 'key_value': row['key_value'], 'label': row['label'],
-                'sort_order': row['sort_order'], 'condition_value': row['condition_value']})
-    # Submit update
-    api.updateOptions(settings.profile_id, option_list_id, body)
+# Bytes of attribute fld holding values in JSON option bodies
+def field_bytes(fld, values):
+    if len(values) == 0:
+        return 0
+    # Encoded values, without the brackets and separators of the list
+    encoded = len(json.dumps(values)) - 2 - 2 * (len(values) - 1)
+    return encoded + len(values) * len('%s: , ' % json.dumps(fld))
 
-# Main program
-def main():
-    # Counter for total API calls used
+# Updates options from input options as pandas df in chunks of
+# settings.chunk_size, sending only the attributes that changed; changed
+# holds a column of booleans per attribute of update_flds. Options with the
+# same changed attributes are sent together, and the bytes of the key value
+# and unchanged attributes left out are recorded on the metrics; returns them
+def send_update(options, changed, option_list_id, api, settings):
+    groups = dict()
+    for pos, key in enumerate(changed[update_flds].itertuples(index = False, name = None)):
+        groups.setdefault(key, []).append(pos)
+    saved = 0
+    for key, group in sorted(groups.items()):
+        flds = [fld for fld, hit in zip(update_flds, key) if hit]
+        sub = options.iloc[group]
+        saved += sum([field_bytes(fld, sub[fld].tolist()) for fld in ['key_value'] + update_flds
+                      if fld not in flds])
+        for body in iter_option_bodies(sub, settings.chunk_size, with_id = True, flds = flds):
+            api.updateOptions(settings.profile_id, option_list_id, body)
+    api.metrics.record_saved(saved)
+    return saved
+
+# Positions of the longest strictly increasing run of values, skipping
+# positions whose value is None
+def increasing_run(values):
+    # Smallest last value, and its position, of the runs found of each length
+    tails = list()
+    tail_pos = list()
+    prev = [None] * len(values)
+    for pos, val in enumerate(values):
+        if val is None:
+            continue
+        i = bisect.bisect_left(tails, val)
+        if i == len(tails):
+            tails.append(val)
+            tail_pos.append(pos)
+        else:
+            tails[i] = val
+            tail_pos[i] = pos
+        prev[pos] = tail_pos[i - 1] if i > 0 else None
+    run = set()
+    pos = tail_pos[-1] if len(tail_pos) > 0 else None
+    while pos is not None:
+        run.add(pos)
+        pos = prev[pos]
+    return run
+
+# The nth (from 0) whole number above lo that is not in the sorted list taken
+def free_sort_order(lo, n, taken):
+    val = lo + 1 + n
+    i = bisect.bisect_right(taken, lo)
+    while i < len(taken) and taken[i] <= val:
+        val += 1
+        i += 1
+    return val
+
+# Sort orders that put the options of op_df in the order of their sort_order
+# while changing as few of the current sort orders in cur_ops as possible.
+# Options in the longest run already in order keep their sort order; the
+# others are spread evenly between their neighbours, or gap apart after the
+# last option. Where neighbours leave too little room, the next option is
+# moved as well. Sort orders of current options not in op_df are never
+# given out, as those options are kept, or deleted only after the others
+# are sent. Returns the sort orders as text by row of op_df, or None if the
+# sort orders are not all whole numbers
+def reconcile_sort(op_df, cur_ops, gap):
+    src = pd.to_numeric(op_df['sort_order'], errors = 'coerce')
+    cur = pd.to_numeric(cur_ops['sort_order_cur'], errors = 'coerce')
+    if src.isna().any() or cur.isna().any() or (src % 1 != 0).any() or (cur % 1 != 0).any():
+        return None
+    cur_sort = dict(zip(cur_ops['key_value_cur'].tolist(), cur.astype('int64').tolist()))
+    src_keys = set(op_df['key_value'].tolist())
+    taken = sorted([val for key, val in cur_sort.items() if key not in src_keys])
+    taken_set = set(taken)
+    order = src.sort_values(kind = 'stable').index
+    values = [cur_sort.get(key) for key in op_df.loc[order, 'key_value'].tolist()]
+    keep = increasing_run(values)
+    new = list(values)
+    # Exclusive lower bound of the sort orders of the options being placed
+    lo = -1
+    run = list()
+    for pos, val in enumerate(values):
+        if pos in keep:
+            # Sort orders between lo and val not held by other options
+            free = val - lo - 1 - (bisect.bisect_left(taken, val) - bisect.bisect_right(taken, lo))
+        if pos in keep and free >= len(run):
+            # Spread the options waiting for a place over the free sort
+            # orders between lo and val
+            step = (free + 1) / (len(run) + 1)
+            for i, run_pos in enumerate(run):
+                new[run_pos] = free_sort_order(lo, int(step * (i + 1)) - 1, taken)
+            run = list()
+            lo = val
+        else:
+            run.append(pos)
+    val = 0 if lo < 0 else lo + gap
+    for run_pos in run:
+        while val in taken_set:
+            val += 1
+        new[run_pos] = val
+        val += gap
+    return pd.Series([str(val) for val in new], index = order).reindex(op_df.index)
+
+# Deletes options from an option list by option id, one filtered delete call
+# per chunk, returning the number of API calls used
+def delete_options(del_ids, option_list_id, op_list, api, settings):
     calls = 0
-    # Parse INI file
-    print("Parsing INI...")
-    global s
-    s = settings()
-    # Get token for IFB API
-    print("Connecting to iFormBuilder API...")
+    nrow = len(del_ids)
+    size = settings.delete_chunk_size
+    for start in range(0, nrow, size):
+        chunk = del_ids[start:start + size]
+        # Field grammar matching any of the option ids in the chunk
+        grammar = 'id(%s)' % '|'.join(['="%s"' % del_id for del_id in chunk])
+        api.deleteOptions(settings.profile_id, option_list_id, grammar = grammar, limit = len(chunk))
+        calls += 1
+        list_message("Deleted options %s to %s of %s from list %s (%s API calls)..." %
+                (start + 1, start + len(chunk), nrow, op_list, calls))
+    return calls
+
+# Hashes each option row, including its list name, to a 64 bit fingerprint
+def option_fingerprints(df):
+    cols = ['name', 'key_value', 'label', 'sort_order', 'condition_value']
+    return pd.util.hash_pandas_object(df[cols].fillna('').astype(str), index = False).values
+
+# Path of the manifest of the last synced source, stored next to the INI file
+def manifest_path(settings):
+    return os.path.join(settings.cur_dir, file_stem(settings) + '_manifest.sqlite')
+
+# Reads the file hashes of the last successful sync from the manifest, or {}
+# if there is none
+def load_manifest(settings):
+    path = manifest_path(settings)
+    if not os.path.exists(path):
+        return {}
+    con = sqlite3.connect(path)
+    try:
+        return dict(con.execute("SELECT key, value FROM meta").fetchall())
+    except sqlite3.Error:
+        return {}
+    finally:
+        con.close()
+
+# Reads the list name and fingerprint of each option row of the last
+# successful sync from the manifest, or None if there is none
+def load_manifest_rows(settings):
+    path = manifest_path(settings)
+    if not os.path.exists(path):
+        return None
+    con = sqlite3.connect(path)
+    try:
+        rows = pd.read_sql_query("SELECT name, fp FROM options", con)
+    except (sqlite3.Error, pd.errors.DatabaseError):
+        return None
+    finally:
+        con.close()
+    # Fingerprints are stored as signed 64 bit integers
+    rows['fp'] = rows['fp'].to_numpy(dtype = 'int64').view('uint64')
+    return rows
+
+# Saves the manifest of a sync from the synced option rows; the source file
+# hash is only recorded if every option list was synced
+def save_manifest(df, settings, complete):
+    source_hash = settings.source_hash if complete else ''
+    meta = {'source_hash': source_hash, 'settings_hash': settings.settings_hash}
+    rows = zip(df['name'].tolist(), df['key_value'].tolist(),
+               option_fingerprints(df).view('int64').tolist())
+    con = sqlite3.connect(manifest_path(settings))
+    try:
+        with con:
+            con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            con.execute("CREATE TABLE IF NOT EXISTS options (name TEXT, key_value TEXT, fp INTEGER)")
+            con.execute("DELETE FROM meta")
+            con.execute("DELETE FROM options")
+            con.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+            con.executemany("INSERT INTO options VALUES (?, ?, ?)", rows)
+    finally:
+        con.close()
+
+# Names of option lists with rows added, changed or removed since the manifest
+def changed_lists(df, rows):
+    fps = option_fingerprints(df)
+    new = df.loc[~np.isin(fps, rows['fp'].to_numpy()), 'name']
+    removed = rows.loc[~np.isin(rows['fp'].to_numpy(), fps), 'name']
+    return set(new.tolist()) | set(removed.tolist())
+
+# Prints a progress message for an option list
+def list_message(msg):
+    with print_lock:
+        print("     " + msg)
+
+# Class holding the outcome of syncing one option list
+class list_result():
+    def __init__(self, name):
+        self.name = name
+        self.list_id = None
+        # ok, skipped or failed
+        self.status = 'ok'
+        self.created = False
+        self.appended = 0
+        self.updated = 0
+        self.deleted = 0
+        self.calls = 0
+        self.error = ''
+
+# Copy of the options of a list with sort orders reconciled with the current
+# options by reconcile_sort, or the options unchanged if that is not possible
+def sort_options(op_df, cur_ops, op_list, settings):
+    sort_order = reconcile_sort(op_df, cur_ops, settings.sort_gap)
+    if sort_order is None:
+        list_message("Sort orders of list %s are not all whole numbers, comparing them as given..." % op_list)
+        return op_df
+    op_df = op_df.copy()
+    op_df['sort_order'] = sort_order
+    return op_df
+
+# Retrieves, compares and pushes the options of one list; errors are kept on
+# the returned result so they do not stop other lists
+def sync_list(op_list, op_df, list_ids, api, settings):
+    res = list_result(op_list)
+    # Requests made by this thread are counted against the option list
+    metrics_local.scope = op_list
     try:
-        api = IFB(s.server_name + ".iformbuilder.com", s.ifb_key, s.ifb_secret)
-    except:
-        sys.exit(("ERROR: Could not connect to the IFB API. This is likely due to"
-                    "invalid credentials or no internet connection."))
-    calls += 1
-    # Get all the option lists in the profile
-    print("Retrieving all option lists in profile...")
-    all_lists = api.readAllOptionLists(s.profile_id)
-    all_names = [op['name'] for op in all_lists]
-    all_ids = [op['id'] for op in all_lists]
-    calls += math.floor(len(all_lists) / 100)
-    # Load CSV file
-    print("Loading CSV file %s" % (s.csv_in))
-    df = load_csv(s.csv_in)
-    # For each unique list names
-    for op_list in sorted(set(df['name'].tolist())):
-        # Subset option list data
-        op_df = df[df['name'] == op_list]
         # Check that all keys are unique
-        if len(op_df['key_value'].tolist()) != len(set(op_df['key_value'].tolist())):
-            print("     ERROR: Option list %s contains duplicate key values, skipping..." % op_list)
-            continue
+        if op_df['key_value'].duplicated().any():
+            list_message("ERROR: Option list %s contains duplicate key values, skipping..." % op_list)
+            res.status, res.error = 'skipped', 'duplicate key values'
+            return res
         # Check that all sort orders are unique
-        if len(op_df['sort_order'].tolist()) != len(set(op_df['sort_order'].tolist())):
-            print("     ERROR: Option list %s contains duplicate sort order values, skipping..." % op_list)
-            continue
+        if op_df['sort_order'].duplicated().any():
+            list_message("ERROR: Option list %s contains duplicate sort order values, skipping..." % op_list)
+            res.status, res.error = 'skipped', 'duplicate sort order values'
+            return res
         # Check if option list name already exists in profile
-        if op_list in all_names:
+        if op_list in list_ids:
             # Get the ID
-            op_list_id = all_ids[all_names.index(op_list)]
+            op_list_id = list_ids[op_list]
+            res.list_id = op_list_id
             # Retrieve options, add _cur suffix
-            cur_ops = retrieve_options(op_list_id, api, s).add_suffix('_cur')
-            calls += math.floor(len(cur_ops.index) / 1000)
+            cur_ops = retrieve_options(op_list_id, api, settings).add_suffix('_cur')
+            # Give new sort orders only to options whose order changed
+            if settings.sort_gap > 0:
+                op_df = sort_options(op_df, cur_ops, op_list, settings)
             ## Append new options
             append_df = op_df[~op_df['key_value'].isin(cur_ops['key_value_cur'].tolist())]
             if len(append_df.index) > 0:
-                print("     Appending %s new options to list %s..." % (len(append_df.index), op_list))
-                send_options(options = append_df, option_list_id = op_list_id, api = api, settings = s)
-                calls += math.floor(len(append_df.index) / 1000)
+                list_message("Appending %s new options to list %s..." % (len(append_df.index), op_list))
+                send_options(options = append_df, option_list_id = op_list_id, api = api, settings = settings)
+                res.appended = len(append_df.index)
             ## Update options
-            if s.update:
-                op_joined = pd.merge(op_df, cur_ops, left_on = 'key_value', right_on = 'key_value_cur')
-                # Filter where cols not equal to find options to update
-                diff_q = ('label != label_cur or sort_order != sort_order_cur'
-                        ' or condition_value != condition_value_cur')
-                update_df = (op_joined
-                    .astype(str)
-                    .query(diff_q)
-                    .filter(['id_cur', 'key_value', 'label', 'sort_order', 'condition_value'])
+            if settings.update:
+                op_joined = pd.merge(op_df, cur_ops, left_on = 'key_value', right_on = 'key_value_cur').astype(str)
+                # Compare each attribute to find options to update and their changed attributes
+                changed = pd.DataFrame(dict([(fld, op_joined[fld] != op_joined[fld + '_cur'])
+                                             for fld in update_flds]), index = op_joined.index)
+                is_changed = changed.any(axis = 1)
+                update_df = (op_joined[is_changed]
+                    .filter(['id_cur', 'key_value'] + update_flds)
                     .rename(columns = {'id_cur': 'id'}))
                 # If any rows send update
                 if len(update_df.index) > 0:
-                    print("     Updating %s options in list %s..." % (len(update_df.index), op_list))
-                    send_update(options = update_df, option_list_id = op_list_id, api = api, settings = s)
-                    calls += math.floor(len(update_df.index) / 1000)
+                    list_message("Updating %s options in list %s..." % (len(update_df.index), op_list))
+                    saved = send_update(update_df, changed[is_changed], op_list_id, api, settings)
+                    list_message("Sent changed attributes only, leaving %.1f KB out of updates of list %s." %
+                                 (saved / 1024.0, op_list))
+                    res.updated = len(update_df.index)
+            ## Delete options not in the source data
+            if settings.delete:
+                del_ids = cur_ops.loc[~cur_ops['key_value_cur'].isin(op_df['key_value']), 'id_cur'].tolist()
+                if len(del_ids) > 0:
+                    list_message("Deleting %s options from list %s..." % (len(del_ids), op_list))
+                    delete_options(del_ids, op_list_id, op_list, api, settings)
+                    res.deleted = len(del_ids)
         else:
             # Create new option list
-            print("     Creating new option list %s..." % op_list)
-            op_list_id = api.createOptionList(s.profile_id, body = {'name': op_list})['id']
+            list_message("Creating new option list %s..." % op_list)
+            op_list_id = api.createOptionList(settings.profile_id, body = {'name': op_list})['id']
             # Check valid option list id
             if op_list_id == 0:
-                print("     ERROR: Option list %s could not be created, skipping..." % op_list)
-                continue
+                list_message("ERROR: Option list %s could not be created, skipping..." % op_list)
+                res.status, res.error = 'failed', 'could not be created'
+                return res
+            res.created = True
+            res.list_id = op_list_id
+            # Leave room between sort orders for later insertions
+            if settings.sort_gap > 0:
+                op_df = sort_options(op_df, pd.DataFrame({'key_value_cur': [], 'sort_order_cur': []}), op_list,
+                                     settings)
             # Push all options as new
-            send_options(options = op_df, option_list_id = op_list_id, api = api, settings = s)
-            calls += math.floor(len(op_df.index) / 1000)
+            send_options(options = op_df, option_list_id = op_list_id, api = api, settings = settings)
+            res.appended = len(op_df.index)
+    except Exception as e:
+        list_message("ERROR: Option list %s failed: %s" % (op_list, e))
+        res.status, res.error = 'failed', str(e)
+    finally:
+        metrics_local.scope = None
+        res.calls = api.metrics.scope_requests(op_list)
+    return res
+
+# Prints a summary table of option list results
+def list_summary(results):
+    if len(results) == 0:
+        return
+    width = max([len(res.name) for res in results] + [11])
+    print()
+    print("%-*s  %-8s %8s %8s %8s %6s  %s" %
+            (width, 'Option list', 'Status', 'Appended', 'Updated', 'Deleted', 'Calls', 'Error'))
+    for res in results:
+        status = 'created' if res.created and res.status == 'ok' else res.status
+        print("%-*s  %-8s %8s %8s %8s %6s  %s" %
+                (width, res.name, status, res.appended, res.updated, res.deleted, res.calls, res.error))
+    failed = len([res for res in results if res.status != 'ok'])
+    print("%s option lists synced, %s skipped or failed." % (len(results) - failed, failed))
+    print()
+
+# Syncs the option lists in the CSV of one INI file, returning the number of
+# API requests made. An already connected api and the profile's option list
+# listing may be passed in to share them between syncs; new option lists are
+# added to the listing. With [Targets], the CSV is loaded once and synced to
+# every target at once
+def sync(cur_dir, config_fn, full_sync = False, api = None, all_lists = None):
+    # Parse INI file
+    print("Parsing INI...")
+    s = settings(cur_dir, config_fn)
+    src = source_data(s)
+    if len(s.targets) == 1:
+        return sync_target(s, src, full_sync, api, all_lists)
+    print("Syncing %s to %s targets..." % (s.csv_in, len(s.targets)))
+    with ThreadPoolExecutor(max_workers = len(s.targets)) as pool:
+        list(pool.map(lambda t: run_target(s, t, src, full_sync, api, all_lists), s.targets))
+    target_summary(s.targets)
+    calls = sum([t.calls or 0 for t in s.targets])
+    failed = len([t for t in s.targets if t.status == 'failed'])
+    if failed > 0:
+        sys.exit("ERROR: %s of %s targets failed to sync. Syncing used %s API calls." %
+                    (failed, len(s.targets), calls))
+    print("Syncing to all targets complete. Syncing used %s API calls." % calls)
+    return calls
+
+# Syncs target t from the source loaded in src, recording its outcome on t;
+# the api and option list listing passed in are for the [API] destination only
+def run_target(s, t, src, full_sync, api, all_lists):
+    start = time.time()
+    shared = t.name == ''
+    try:
+        t.calls = sync_target(target_settings(s, t), src, full_sync, api if shared else None,
+                              all_lists if shared else None)
+        t.status = 'ok'
+    except SystemExit as e:
+        t.status = 'failed'
+        t.error = str(e)
+    except Exception as e:
+        t.status = 'failed'
+        t.error = '%s: %s' % (type(e).__name__, e)
+    t.seconds = time.time() - start
+    return t
+
+# Class loading the source CSV of a sync when first needed, once for all of
+# its targets, with its options partitioned by option list
+class source_data():
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.df = None
+        # Options of each option list, by name
+        self.groups = None
+
+    # Loads the CSV on first use
+    def load(self):
+        with self.lock:
+            if self.df is None:
+                load_pandas()
+                print("Loading CSV file %s" % (self.settings.csv_in))
+                df = load_csv(self.settings.csv_in, self.settings)
+                self.groups = dict(list(df.groupby('name', sort = True)))
+                self.df = df
+        return self
+
+# Syncs the option lists in the CSV loaded by src with the profile of the
+# target of settings s, returning the number of API requests made
+def sync_target(s, src, full_sync = False, api = None, all_lists = None):
+    # API requests and phase timings of the run
+    m = metrics()
+    # Skip the sync if neither the source nor the settings changed since the
+    # last successful sync
+    manifest = {}
+    if s.incremental:
+        manifest = load_manifest(s)
+        s.source_hash = file_hash(os.path.join(s.cur_dir, s.csv_in))
+        s.settings_hash = file_hash(os.path.join(s.cur_dir, s.config_fn))
+        if full_sync:
+            print("Full sync requested, ignoring changes since last sync...")
+        elif manifest.get('source_hash') == s.source_hash and manifest.get('settings_hash') == s.settings_hash:
+            print("Source data and settings unchanged since last sync, nothing to push.")
+            calls = finish_metrics(m, s)
+            print("Syncing complete. Syncing used %s API calls." % calls)
+            return calls
+    # Get token for IFB API
+    m.phase('connect')
+    if api is None:
+        print("Connecting to iFormBuilder API...")
+        start = time.time()
+        try:
+            api = IFB(s.server_name + ".iformbuilder.com", s.ifb_key, s.ifb_secret)
+        except:
+            sys.exit(("ERROR: Could not connect to the IFB API. This is likely due to"
+                        "invalid credentials or no internet connection."))
+        # The token request is made before the session can be metered
+        m.record_call('token', time.time() - start)
+        m.record_request('token', time.time() - start, 0, 0, True)
+    schedule_api(api, s.rate_limit, s.max_retries)
+    api = metered_api(api, m)
+    # Get all the option lists in the profile
+    m.phase('fetch remote')
+    if all_lists is None:
+        print("Retrieving all option lists in profile...")
+        all_lists = api.readAllOptionLists(s.profile_id)
+    all_names = [op['name'] for op in all_lists]
+    all_ids = [op['id'] for op in all_lists]
+    # Load CSV file
+    m.phase('load csv')
+    df = src.load().df
+    list_names = sorted(set(df['name'].tolist()))
+    # Only sync option lists with rows changed since the last sync
+    m.phase('diff')
+    manifest_rows = None
+    if s.incremental and not full_sync and manifest.get('settings_hash') == s.settings_hash:
+        manifest_rows = load_manifest_rows(s)
+    if manifest_rows is not None:
+        changed = changed_lists(df, manifest_rows)
+        print("%s of %s option lists changed since last sync." % (len(changed & set(list_names)), len(list_names)))
+        list_names = [op_list for op_list in list_names if op_list in changed]
+    # Option list IDs by name, keeping the first where names are duplicated
+    list_ids = dict()
+    for name, op_list_id in zip(all_names, all_ids):
+        list_ids.setdefault(name, op_list_id)
+    # Sync lists concurrently from the options partitioned by list once; the
+    # append, update and delete time of each list is in its API method times
+    m.phase('sync lists')
+    groups = src.groups
+    with ThreadPoolExecutor(max_workers = s.workers) as pool:
+        results = list(pool.map(lambda op_list: sync_list(op_list, groups[op_list], list_ids, api, s),
+                                list_names))
+    list_summary(results)
+    all_lists.extend([{'id': res.list_id, 'name': res.name} for res in results if res.created])
+    # Option lists skipped due to errors
+    skipped = set([res.name for res in results if res.status != 'ok'])
+    # Record the synced source; rows of skipped lists are left out so they
+    # are retried on the next sync
+    if s.incremental:
+        m.phase('save manifest')
+        save_manifest(df[~df['name'].isin(skipped)], s, len(skipped) == 0)
     # Complete
+    calls = finish_metrics(m, s)
     print("Syncing complete. Syncing used %s API calls." % calls)
+    return calls
+
+# Main program
+def main():
+    cur_dir, config_fn, full_sync = parse_args()
+    print_banner()
+    sync(cur_dir, config_fn, full_sync)
 
 
 if __name__ == '__main__':